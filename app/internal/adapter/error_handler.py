@@ -1,14 +1,11 @@
 # Path: ols_svc_sample/app/internal/adapters/error.py
 
-import json, time
 from fastapi import HTTPException, Request, status
 from fastapi.responses import Response, JSONResponse
 from ..infrastructure.logger import log
 
 ## HTTP Exception
 async def http_exception_handler(request: Request, exc: HTTPException):
-    ## Calculate the request processing time of http exception
-    process_time = (time.time() - request.state.start_time) * 1000
     ## Check HTTP status code and return appropriate response
     if exc.status_code == status.HTTP_501_NOT_IMPLEMENTED:
         return JSONResponse(
@@ -24,6 +21,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         return JSONResponse(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             content={"detail": exc.detail},
+            headers=exc.headers,
         )
     elif exc.status_code == status.HTTP_504_GATEWAY_TIMEOUT:
         return JSONResponse(
@@ -65,6 +63,16 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             status_code=status.HTTP_409_CONFLICT,
             content={"detail": exc.detail},
         )
+    elif exc.status_code == status.HTTP_412_PRECONDITION_FAILED:
+        return JSONResponse(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            content={"detail": exc.detail},
+        )
+    elif exc.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE:
+        return JSONResponse(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            content={"detail": exc.detail},
+        )
     elif exc.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY:
         return JSONResponse(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -74,36 +82,15 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         return JSONResponse(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             content={"detail": exc.detail},
+            headers=exc.headers,
         )
     elif exc.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR:
         ## Print stack trace
         log.debug("print stack trace for status code 500: ")
         import traceback
         log.debug(traceback.format_exc())
-        ## Exception response header
-        response_header = {
-            "Content-Type": "text/plain",
-            "Content-Length": "21",
-        }
-        ## Exception response body
-        response_body = {
-            "detail": exc.detail
-        }
-        structured_log = {
-            "method": request.method,
-            "status_code": exc.status_code,
-            "path": request.url.path,
-            "latency": f"{process_time:.2f}ms",
-            "request": {
-                "headers": dict(request.headers),
-                # "body": dict(request.body()),
-            },
-            "response": {
-                "headers": response_header,
-                "body": response_body,
-            }    
-        }
-        log.fatal(json.dumps(structured_log))
+        ## the access log of the middleware, with its allow-listed headers, carries the detail of the error
+        request.state.error_detail = exc.detail
         return Response(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content="Internal Server Error",
@@ -1,49 +1,142 @@
 # Path: ols_svc_sample/app/internal/adapters/event_handler.py
 
-from contextlib import asynccontextmanager
+import asyncio, time
+from contextlib import asynccontextmanager, AsyncExitStack
 from ..config import get_settings
 from redis import asyncio as aioredis
-from fastapi_limiter import FastAPILimiter
 from ..infrastructure.logger import log
-from ..infrastructure.databases.mongodb import Mongo
-# from fastapi_limiter.depends import RateLimiter
+from ..infrastructure.metrics import metrics
+from ..infrastructure.indexes import report_drift, require_email_guards
+from ..infrastructure.deadline import deadline_scopes
+from ..infrastructure.cache.memory import MemoryCache, listen_invalidation
+from ..infrastructure.ratelimit import limiter
 
 settings = get_settings()
 if settings.cloud_provider == "aws":
     import aioboto3
+    from aiobotocore.config import AioConfig
     from ..infrastructure.aws.sts import get_aws_credentials
+    from ..infrastructure.aws.dynamodb import PROFILE_INDEXES as DYNAMODB_INDEXES, EMAIL_GUARD_KEY, check_indexes, check_key, check_email_guards
 
     dynamodb = {}
+elif settings.cloud_provider == "gcp":
+    from ..infrastructure.gcp.firestore import Firestore, PROFILE_INDEXES as FIRESTORE_INDEXES, check_indexes, check_email_guards
+
+    firestore = {}
 elif settings.cloud_provider == "local":
-    mongo_collection = Mongo().getCollection()
-    redis = {}
+    import pymongo
+    from ..infrastructure.databases.mongodb import Mongo, PROFILE_INDEXES as MONGO_INDEXES, ensure_indexes, read_preference, check_read_your_writes, unique_email
+
+    mongo = {}
+redis = {}
+
+# Open connections of a pool with concurrent round trips, so the first requests do not pay for the connection setup;
+# best effort, a backend that is down at startup is connected to by the first requests (redis being optional)
+async def warm_up(name: str, ping, connections: int):
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(ping() for _ in range(connections))), settings.pool_warmup_timeout)
+    except Exception as e:
+        log.warning(f"{name} connection pool is not warmed up, starting anyway: {e!r}")
+        return
+    log.info(f"{name} connection pool is warmed up with {connections} connections in {(time.monotonic() - start) * 1000:.0f}ms")
+
+# Utilization of the redis connection pool
+def redis_pool_stats(pool) -> dict:
+    ### the blocking pool queues its idle connections, and None for the ones not yet opened
+    idle = sum(1 for connection in pool.pool._queue if connection is not None)
+    return {"size": pool.max_connections, "open": len(pool._connections), "in_use": len(pool._connections) - idle}
 
 @asynccontextmanager
 async def lifespan(app):
-    if settings.cloud_provider == "aws":
-      # dynamodb
-      if settings.use_irsa:
-          async with aioboto3.Session().resource(
-              "dynamodb", region_name=settings.aws_region
-          ) as resource:
-              dynamodb["table"] = await resource.Table(settings.dynamodb_table)
-              yield
-      else:
-          credentials = get_aws_credentials()
-          async with aioboto3.Session().resource(
-              "dynamodb",
-              aws_access_key_id=credentials["AccessKeyId"],
-              aws_secret_access_key=credentials["SecretAccessKey"],
-              aws_session_token=credentials["SessionToken"],
-              region_name=settings.aws_region,
-          ) as resource:
-              dynamodb["table"] = await resource.Table(settings.dynamodb_table)
-              yield
-    elif settings.cloud_provider == "local":
-        await mongo_collection.create_index("uuid", unique=True)
+    async with AsyncExitStack() as stack:
+        if settings.cloud_provider == "aws":
+            # dynamodb
+            ## one aiohttp connection pool, shared by the table resources and the low level client
+            config = AioConfig(
+                max_pool_connections=settings.db_pool_size,
+                connect_timeout=settings.db_connect_timeout,
+                tcp_keepalive=settings.db_socket_keepalive,
+                connector_args={"keepalive_timeout": settings.db_pool_idle_timeout},
+            )
+            if settings.use_irsa:
+                resource = await stack.enter_async_context(aioboto3.Session().resource(
+                    "dynamodb", region_name=settings.aws_region, config=config
+                ))
+            else:
+                credentials = get_aws_credentials()
+                resource = await stack.enter_async_context(aioboto3.Session().resource(
+                    "dynamodb",
+                    aws_access_key_id=credentials["AccessKeyId"],
+                    aws_secret_access_key=credentials["SecretAccessKey"],
+                    aws_session_token=credentials["SessionToken"],
+                    region_name=settings.aws_region,
+                    config=config,
+                ))
+            dynamodb["resource"] = resource
+            dynamodb["table"] = await resource.Table(settings.dynamodb_table)
+            dynamodb["emails"] = await resource.Table(settings.dynamodb_email_table)
+            if settings.index_policy != "off":
+                report_drift("DynamoDB", await check_indexes(dynamodb["table"], DYNAMODB_INDEXES) + await check_key(dynamodb["emails"], EMAIL_GUARD_KEY))
+            ## emails are unique only through their guard items, which existing profiles get from the backfill
+            require_email_guards("DynamoDB", await check_email_guards(dynamodb["table"], dynamodb["emails"]))
+            await warm_up("DynamoDB", lambda: resource.meta.client.describe_table(TableName=settings.dynamodb_table), min(settings.pool_warmup, settings.db_pool_size))
+            metrics.register("dynamodb_pool", lambda: {"size": settings.db_pool_size})
+        elif settings.cloud_provider == "gcp":
+            # firestore
+            database = Firestore()
+            firestore["client"] = database.client
+            firestore["collection"] = database.getCollection()
+            firestore["emails"] = database.client.collection(settings.firestore_email_collection)
+            if settings.index_policy != "off":
+                report_drift("Firestore", await check_indexes(FIRESTORE_INDEXES))
+            ## emails are unique only through their guard documents, which existing profiles get from the backfill
+            require_email_guards("Firestore", await check_email_guards(firestore["client"], firestore["collection"], firestore["emails"]))
+            await warm_up("Firestore", database.ping, 1)
+        elif settings.cloud_provider == "local":
+            # mongodb
+            database = Mongo()
+            stack.callback(database.close)
+            ## the deadline of a request is sent along its mongo operations (maxTimeMS) and bounds their socket reads
+            deadline_scopes.append(pymongo.timeout)
+            stack.callback(deadline_scopes.remove, pymongo.timeout)
+            mongo["collection"] = database.getCollection()
+            ## the same collection, read with the read preference of each kind of read
+            check_read_your_writes(settings.read_your_writes_window, settings.mongo_max_staleness, settings.mongo_read_preference_scan, settings.mongo_read_preference_get)
+            mongo["scan"] = mongo["collection"].with_options(read_preference=read_preference(settings.mongo_read_preference_scan, settings.mongo_max_staleness))
+            mongo["get"] = mongo["collection"].with_options(read_preference=read_preference(settings.mongo_read_preference_get, settings.mongo_max_staleness))
+            if settings.index_policy != "off":
+                report_drift("Mongo", await ensure_indexes(mongo["collection"], MONGO_INDEXES))
+            ## without the unique email index (not created, or not buildable over duplicates) the emails are checked before writing
+            mongo["unique_email"] = await unique_email(mongo["collection"])
+            if not mongo["unique_email"]:
+                log.warning("Mongo unique index email_1 is missing, emails are checked before each write, which concurrent writes can race")
+            await warm_up("Mongo", database.ping, min(settings.pool_warmup, settings.db_pool_size))
+            metrics.register("mongo_pool", lambda: {"size": settings.db_pool_size, **database.stats.snapshot()})
+        # redis, used by the rate limiter and the profile cache of every cloud provider
         uri = f"redis://:{settings.redis_pass}@{settings.redis_host}:{settings.redis_port}/{settings.redis_db}"
-        redis["ttl"] = settings.redis_ttl
-        async with aioredis.from_url(uri, encoding="utf-8", decode_responses=True) as client:
-            redis["client"] = client
-            await FastAPILimiter.init(redis["client"])
-            yield
\ No newline at end of file
+        ## requests wait for a free connection rather than failing when the pool is exhausted
+        pool = aioredis.BlockingConnectionPool.from_url(
+            uri,
+            max_connections=settings.redis_pool_size,
+            timeout=settings.redis_pool_timeout,
+            socket_connect_timeout=settings.redis_connect_timeout,
+            socket_keepalive=settings.redis_socket_keepalive,
+            socket_timeout=settings.redis_socket_timeout,
+            health_check_interval=settings.redis_health_check_interval,
+        )
+        stack.push_async_callback(pool.disconnect)
+        ## responses are kept as bytes so cached profiles are served without decoding
+        client = await stack.enter_async_context(aioredis.Redis(connection_pool=pool, decode_responses=False))
+        redis["client"] = client
+        await warm_up("Redis", client.ping, min(settings.pool_warmup, settings.redis_pool_size))
+        metrics.register("redis_pool", lambda: redis_pool_stats(pool))
+        ## rate limit buckets, reconciled with the other workers through redis
+        reconciler = asyncio.create_task(limiter.run(client if settings.rate_limit_distributed else None))
+        stack.callback(reconciler.cancel)
+        ## L1 cache, invalidated across workers through redis pub/sub
+        if settings.l1_cache_enabled:
+            redis["l1"] = MemoryCache(settings.l1_cache_size, settings.l1_cache_ttl)
+            listener = asyncio.create_task(listen_invalidation(client, settings.l1_cache_channel, redis["l1"]))
+            stack.callback(listener.cancel)
+        yield
@@ -1,87 +1,79 @@
 # Path: ols_svc_sample/app/internal/adapters/middleware.py
 
-import json, gzip, time
-from fastapi import Request
-# from starlette.concurrency import iterate_in_threadpool
-from starlette.middleware.base import BaseHTTPMiddleware
+import random, time
 from ..infrastructure.logger import log
+from ..config import get_settings
+
+settings = get_settings()
+
+# Allow-list of a comma separated setting, as lower case header names
+def header_names(names: str) -> frozenset:
+    return frozenset(name.strip().lower() for name in names.split(",") if name.strip())
 
 ## Logging Middleware
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = None
-        request.state.start_time = time.time()
-        ### Call the next middleware or route handler
-        response = await call_next(request)
-        ### Calculate the request processing time    
-        process_time = (time.time() - request.state.start_time) * 1000
+class LoggingMiddleware:
+    # Pure ASGI access log: the status and the latency are captured from the messages sent,
+    # successful requests are sampled, errors and slow requests are always logged
+    def __init__(self, app):
+        self.app = app
+        self.request_headers = header_names(settings.log_request_headers)
+        self.response_headers = header_names(settings.log_response_headers)
 
-        # response_body = [chunk async for chunk in response.body_iterator]
-        # response.body_iterator = iterate_in_threadpool(iter(response_body))
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        ### the start time is read by the error handlers
+        start = time.time()
+        scope.setdefault("state", {})["start_time"] = start
+        response = {}
 
-        # if len(response_body) > 0:
-        #     if response.headers.get("Content-Type", "") == "application/json":
-        #         response_body_txt = json.loads(response_body[0])
-        #     else:
-        #         response_body_txt = response_body[0]
-        # else:
-        #     response_body_txt = ""
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            await send(message)
 
-        ### Set log level and format log accordingly
-        if request.url.path.startswith("/profile-gql"):
-            structured_log = {
-                "method": request.method,
-                "status_code": response.status_code,
-                "path": request.url.path,
-                "latency": f"{process_time:.2f}ms",
-                "request": {
-                    "headers": dict(request.headers),
-                    # "body": dict(request.body()),
-                },
-                "response": {
-                    "headers": dict(response.headers),
-                    # "body": response_body_txt,
-                }    
-            }
-            # if response_body_txt.get('data') is None:
-            #     if response_body_txt.get('errors'):
-            #         if response_body_txt['errors'][0].get('extensions'):
-            #             log.fatal(json.dumps(structured_log))
-            #         else:
-            #             log.warning(json.dumps(structured_log))
-            # else:
-            #     log.info(json.dumps(structured_log))
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception:
+            ### answered with a 500 by the server error middleware, outside of this one
+            response.setdefault("status", 500)
+            raise
+        finally:
+            self.log(scope, response, (time.time() - start) * 1000)
+
+    def log(self, scope, response: dict, process_time: float):
+        status_code = response.get("status", 500)
+        slow = process_time >= settings.log_slow_threshold
+        ### decide before building anything, most successful requests are not logged when sampled
+        if status_code < 400 and not slow and (settings.log_sample_rate < 1.0 and random.random() >= settings.log_sample_rate):
+            return
+        structured_log = {
+            "method": scope["method"],
+            "status_code": status_code,
+            "path": scope["path"],
+            "latency": f"{process_time:.2f}ms",
+            "request_headers": self.headers(scope["headers"], self.request_headers),
+            "response_headers": self.headers(response.get("headers", []), self.response_headers),
+        }
+        ### the detail of an internal error, left by the error handler
+        if scope["state"].get("error_detail") is not None:
+            structured_log["response_body"] = {"detail": scope["state"]["error_detail"]}
+        ### the fields are encoded by the log writer, off the event loop
+        message = f"{scope['method']} {scope['path']} {status_code}"
+        if status_code >= 500:
+            log.error(message, extra={"fields": structured_log})
+        elif status_code >= 400 or slow:
+            log.warning(message, extra={"fields": structured_log})
         else:
-            if 400 <= response.status_code < 500:
-                structured_log = {
-                    "method": request.method,
-                    "status_code": response.status_code,
-                    "path": request.url.path,
-                    "latency": f"{process_time:.2f}ms",
-                    "request": {
-                        "headers": dict(request.headers),
-                        # "body": dict(request.body()),
-                    },
-                    "response": {
-                        "headers": dict(response.headers),
-                        # "body": response_body_txt,
-                    }    
-                }
-                log.warning(json.dumps(structured_log))
-            elif 200<= response.status_code < 400:
-                structured_log = {
-                    "method": request.method,
-                    "status_code": response.status_code,
-                    "path": request.url.path,
-                    "latency": f"{process_time:.2f}ms",
-                    "request": {
-                        "headers": dict(request.headers),
-                        # "body": dict(request.body()),
-                    },
-                    "response": {
-                        "headers": dict(response.headers),
-                        # "body": response_body_txt,
-                    }    
-                }
-                log.info(json.dumps(structured_log))
-        return response
\ No newline at end of file
+            log.info(message, extra={"fields": structured_log})
+
+    ## Decode the allowed headers only, asgi header names are lower case
+    def headers(self, raw: list, allowed: frozenset) -> dict:
+        headers = {}
+        for name, value in raw:
+            name = name.decode("latin-1")
+            if name in allowed:
+                headers[name] = value.decode("latin-1")
+        return headers
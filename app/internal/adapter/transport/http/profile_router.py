@@ -2,9 +2,8 @@
 
 from fastapi import APIRouter, status, Depends
 from ....config import get_settings
-from ....domain.models.profile import Profile
-from ....application.http.profile_service import ProfileService
-from fastapi_limiter.depends import RateLimiter
+from ....domain.models.profile import Profile, ProfilePage, BatchResult, ProfileResult
+from ....application.http.profile_service import ProfileService, read_your_writes, mark_write, request_deadline, rate_limit
 
 # from .....dependencies import get_token_header
 
@@ -16,14 +15,20 @@ profile_http_router = APIRouter(
     prefix="/v1",
 )
 
-profile_http_router.add_api_route("/profiles", profile_service.list, methods=["GET"], response_model=list[Profile], dependencies=[Depends((RateLimiter(times=settings.rate_limit_times, seconds=settings.rate_limit_seconds)))])
-profile_http_router.add_api_route("/profiles/{uuid}", profile_service.get, methods=["GET"], response_model=Profile, dependencies=[Depends((RateLimiter(times=settings.rate_limit_times, seconds=settings.rate_limit_seconds)))])
-profile_http_router.add_api_route("/profiles", profile_service.post, methods=["POST"], response_model=Profile, status_code=status.HTTP_201_CREATED, dependencies=[Depends((RateLimiter(times=settings.rate_limit_times, seconds=settings.rate_limit_seconds)))])
-profile_http_router.add_api_route("/profiles/{uuid}", profile_service.put, methods=["PUT"], response_model=Profile, dependencies=[Depends((RateLimiter(times=settings.rate_limit_times, seconds=settings.rate_limit_seconds)))])
-profile_http_router.add_api_route("/profiles/{uuid}", profile_service.delete, methods=["DELETE"], status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends((RateLimiter(times=settings.rate_limit_times, seconds=settings.rate_limit_seconds)))])
+profile_http_router.add_api_route("/profiles", profile_service.list, methods=["GET"], response_model=list[Profile] | ProfilePage | list[ProfileResult], dependencies=[Depends(rate_limit("list")), Depends(request_deadline(settings.request_timeout)), Depends(read_your_writes)])
+profile_http_router.add_api_route("/profiles/export", profile_service.export, methods=["GET"], dependencies=[Depends(rate_limit("export")), Depends(read_your_writes)])
+profile_http_router.add_api_route("/profiles/{uuid}", profile_service.get, methods=["GET"], response_model=Profile, dependencies=[Depends(rate_limit("get")), Depends(request_deadline(settings.request_timeout)), Depends(read_your_writes)])
+profile_http_router.add_api_route("/profiles", profile_service.post, methods=["POST"], response_model=Profile, status_code=status.HTTP_201_CREATED, dependencies=[Depends(rate_limit("post")), Depends(request_deadline(settings.request_timeout)), Depends(mark_write)])
+profile_http_router.add_api_route("/profiles/{uuid}", profile_service.put, methods=["PUT"], response_model=Profile, dependencies=[Depends(rate_limit("put")), Depends(request_deadline(settings.request_timeout)), Depends(mark_write)])
+profile_http_router.add_api_route("/profiles/{uuid}", profile_service.delete, methods=["DELETE"], status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(rate_limit("delete")), Depends(request_deadline(settings.request_timeout)), Depends(mark_write)])
+profile_http_router.add_api_route("/profiles:batchGet", profile_service.postMany, methods=["POST"], response_model=list[ProfileResult], dependencies=[Depends(rate_limit("postMany")), Depends(request_deadline(settings.request_timeout_batch)), Depends(read_your_writes)])
+profile_http_router.add_api_route("/profiles:batch", profile_service.postBatch, methods=["POST"], response_model=list[BatchResult], dependencies=[Depends(rate_limit("postBatch")), Depends(request_deadline(settings.request_timeout_batch)), Depends(mark_write)])
+profile_http_router.add_api_route("/profiles:batch", profile_service.putBatch, methods=["PUT"], response_model=list[BatchResult], dependencies=[Depends(rate_limit("putBatch")), Depends(request_deadline(settings.request_timeout_batch)), Depends(mark_write)])
+profile_http_router.add_api_route("/profiles:batch", profile_service.deleteBatch, methods=["DELETE"], response_model=list[BatchResult], dependencies=[Depends(rate_limit("deleteBatch")), Depends(request_deadline(settings.request_timeout_batch)), Depends(mark_write)])
 profile_http_router.add_api_route("/healthcheck", profile_service.health, methods=["GET"], status_code=status.HTTP_200_OK)
+profile_http_router.add_api_route("/metrics", profile_service.metrics, methods=["GET"], status_code=status.HTTP_200_OK)
 
-# profile_http_router.add_api_route("/profiles", profile_service.list, methods=["GET"], response_model=list[Profile], dependencies=[Depends(get_token_header)])
+# profile_http_router.add_api_route("/profiles", profile_service.list, methods=["GET"], response_model=list[Profile] | ProfilePage, dependencies=[Depends(get_token_header)])
 # profile_http_router.add_api_route("/profiles/{profileUserId}", profile_service.get, methods=["GET"], response_model=Profile, dependencies=[Depends(get_token_header)])
 # profile_http_router.add_api_route("/profiles", profile_service.post, methods=["POST"], response_model=Profile, status_code=status.HTTP_201_CREATED, dependencies=[Depends(get_token_header)])
 # profile_http_router.add_api_route("/profiles/{profileUserId}", profile_service.put, methods=["PUT"], response_model=Profile, dependencies=[Depends(get_token_header)])
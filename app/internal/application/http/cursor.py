@@ -0,0 +1,23 @@
+# Path: ols_svc_sample/app/internal/application/http/cursor.py
+
+import base64, hashlib, hmac
+from fastapi import HTTPException, status
+from ...config import get_settings
+
+settings = get_settings()
+
+def _sign(payload: bytes) -> str:
+    digest = hmac.new(settings.cursor_secret.encode(), payload, hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+# Opaque cursor token carrying the key of the last item of a page
+def encode_cursor(key: str) -> str:
+    payload = base64.urlsafe_b64encode(key.encode()).rstrip(b"=").decode()
+    return f"{payload}.{_sign(payload.encode())}"
+
+# Key carried by a cursor token, rejecting tokens that were not issued by this service
+def decode_cursor(cursor: str) -> str:
+    payload, _, signature = cursor.partition(".")
+    if not signature or not hmac.compare_digest(signature, _sign(payload.encode())):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode()
@@ -1,123 +1,329 @@
 # Path: ols_svc_sample/app/internal/application/http/profile_service.py
 
-import ujson
+from __future__ import annotations
+import hashlib, math, time, orjson
 from uuid import uuid4
 from datetime import datetime
-from starlette.exceptions import HTTPException
-from ...domain.models.profile import ProfileCreate, ProfileUpdate
+from fastapi import status, APIRouter, Body, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from ...domain.models.profile import Profile, ProfileCreate, ProfileUpdate, ProfilePage, ProfileBatchUpdate, BatchResult, ProfileResult, narrow_profile_list, narrow_profile_page
+from .cursor import encode_cursor, decode_cursor
 from ....internal.config import get_settings
 from ...infrastructure.logger import log
+from ...infrastructure.metrics import metrics
+from ...infrastructure.consistency import recent_write
+from ...infrastructure.deadline import deadline
+from ...infrastructure.cache.encoding import negotiate
+from ...infrastructure.ratelimit import limiter, parse_limits
+from ...infrastructure.repositories.cached.profile_repository import CachedProfileRepository, default
 
 settings = get_settings()
 
 if settings.cloud_provider == "aws":
-    from fastapi import status, APIRouter, HTTPException
     from ...infrastructure.repositories.aws.profile_repository import ProfileRepository
 elif settings.cloud_provider == "gcp":
     from ...infrastructure.repositories.gcp.profile_repository import ProfileRepository
 elif settings.cloud_provider == "local":
-    from fastapi import status, APIRouter, HTTPException, Request, Response
-    from fastapi.responses import JSONResponse
     from ...infrastructure.repositories.local.profile_repository import ProfileRepository
 
+if settings.cache_backend == "memory":
+    from ...infrastructure.cache.memory import MemoryCacheStore as CacheStore
+else:
+    from ...infrastructure.cache.redis_store import RedisCacheStore as CacheStore
+    from ...infrastructure.cache.guarded import GuardedCacheStore
+
+# ETag of a profile, derived from its version (updatedAt) and the sparse fieldset if any
+def make_etag(uuid: str, version: str, fields: tuple[str, ...] | None = None) -> str:
+    key = f"{uuid}:{version}:{','.join(fields)}" if fields else f"{uuid}:{version}"
+    return '"' + hashlib.blake2b(key.encode(), digest_size=8).hexdigest() + '"'
+
+# Response of a cached body, sending the compressed variant accepted by the client as is,
+# other responses are left to the gzip middleware
+def entry_response(entry, request: Request = None) -> Response:
+    coding, body = negotiate(request.headers.get("accept-encoding") if request else None, entry.variants)
+    response = Response(content=body or entry.body, media_type="application/json")
+    if entry.variants:
+        response.headers["Vary"] = "Accept-Encoding"
+    if coding:
+        metrics.incr(f"precompressed:{coding}")
+        response.headers["Content-Encoding"] = coding
+    return response
+
+# Detail of the items of a batch that failed, by status
+batch_details = {
+    status.HTTP_404_NOT_FOUND: "Profile not found",
+    status.HTTP_409_CONFLICT: "Profile email already exist",
+    status.HTTP_412_PRECONDITION_FAILED: "Profile has been modified",
+    status.HTTP_500_INTERNAL_SERVER_ERROR: "Internal Server Error",
+}
+
+# Parse a sparse fieldset (?fields=a,b), always with the uuid and in a canonical order
+def parse_fields(fields: str | None = None) -> tuple[str, ...] | None:
+    if not fields:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - Profile.model_fields.keys()
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(sorted(names | {"uuid"}))
+
+# Check an If-None-Match (weak comparison) or If-Match (strong comparison) header against an etag
+def etag_matches(header: str, etag: str, weak: bool = True) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    if "*" in tags:
+        return True
+    if weak:
+        tags = [tag.removeprefix("W/") for tag in tags]
+    return etag in tags
+
+# Send the reads of a client that wrote within the read-your-writes window to the primary
+async def read_your_writes(request: Request):
+    if request.cookies.get("recent_write"):
+        recent_write.set(True)
+
+# Mark the client of a write, for the read-your-writes window
+async def mark_write(response: Response):
+    if settings.read_your_writes_window > 0:
+        response.set_cookie("recent_write", "1", max_age=settings.read_your_writes_window, httponly=True)
+
+# Set the deadline of a request from its X-Request-Timeout header (milliseconds), else from the default of its route
+def request_deadline(default: int | None = None):
+    async def set_deadline(request: Request):
+        timeout = request.headers.get("x-request-timeout")
+        if timeout is not None:
+            if not timeout.isdigit() or int(timeout) <= 0:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid X-Request-Timeout")
+            timeout = min(int(timeout), settings.request_timeout_max)
+        else:
+            timeout = default
+        if timeout:
+            deadline.set(time.monotonic() + timeout / 1000)
+    return set_deadline
+
+# Limit the requests to a route per api key, or per client address for clients without a configured key
+def rate_limit(route: str):
+    times, seconds = parse_limits(settings.rate_limit_routes).get(route, (settings.rate_limit_times, settings.rate_limit_seconds))
+    api_keys = parse_limits(settings.rate_limit_api_keys)
+    async def check_rate_limit(request: Request):
+        api_key = request.headers.get(settings.rate_limit_api_key_header)
+        if api_key in api_keys:
+            ### the key is not sent to redis as is
+            identity, (limit, window) = "key:" + hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest(), api_keys[api_key]
+        else:
+            forwarded = request.headers.get("x-forwarded-for")
+            identity, (limit, window) = "ip:" + (forwarded.split(",")[0].strip() if forwarded else request.client.host if request.client else "unknown"), (times, seconds)
+        wait = limiter.acquire(f"{route}:{identity}", limit, window)
+        if wait:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail={"msg": "Too Many Requests", "reason": f"Rate limit of {limit} requests per {window} seconds exceeded"},
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+    return check_rate_limit
+
 class ProfileService:
     def __init__(self):
-        self.profile_repo = ProfileRepository()
+        ## the memory store is bounded by a number of profiles, redis by its own eviction policy
+        store = CacheStore(settings.cache_memory_size) if settings.cache_backend == "memory" else CacheStore()
+        ## a failing redis degrades to datastore reads rather than failing the requests
+        if settings.cache_backend != "memory" and settings.cache_breaker_enabled:
+            store = GuardedCacheStore(store)
+        self.profile_repo = CachedProfileRepository(ProfileRepository(), store)
+
+    # List profiles, by cursor (an empty cursor starts from the first page), by offset or by uuids (?ids=a,b,c)
+    async def list(self, offset: int = 0, limit: int = 10, cursor: str | None = None, fields: str | None = None, ids: str | None = None) -> APIRouter:
+        fields = parse_fields(fields)
+        if ids is not None:
+            return await self.getMany([id.strip() for id in ids.split(",") if id.strip()], fields)
+        if cursor is None:
+            profiles = await self.profile_repo.list(offset, limit, fields)
+            if fields:
+                ## validate against the narrowed profile, so the response carries the fieldset only
+                adapter = narrow_profile_list(fields)
+                return Response(content=adapter.dump_json(adapter.validate_python(profiles, from_attributes=True)), media_type="application/json")
+            return profiles
+        profiles, last = await self.profile_repo.listAfter(decode_cursor(cursor) if cursor else None, limit, fields)
+        if fields:
+            page = narrow_profile_page(fields).model_validate({"data": profiles, "next_cursor": encode_cursor(last) if last else None}, from_attributes=True)
+            return Response(content=page.model_dump_json(), media_type="application/json")
+        return ProfilePage(data=profiles, next_cursor=encode_cursor(last) if last else None)
+
+    # Export every profile as NDJSON, with a checkpoint line after each batch to resume from
+    async def export(self, checkpoint: str | None = None) -> StreamingResponse:
+        batches = self.profile_repo.export(decode_cursor(checkpoint) if checkpoint else None)
+        ## read the first batch before responding, so datastore errors still get a proper status
+        first = await anext(batches, None)
 
-    async def list(self, offset: int = 0, limit: int = 10) -> APIRouter:
-        profiles = await self.profile_repo.list(offset, limit)
-        return profiles
+        async def lines():
+            batch = first
+            try:
+                while batch:
+                    data, last = batch
+                    ### one chunk per batch, the next batch is only fetched once this one is sent
+                    yield b"".join(orjson.dumps(datum, default=default) + b"\n" for datum in data) + orjson.dumps({"checkpoint": encode_cursor(last)}) + b"\n"
+                    batch = await anext(batches, None)
+            finally:
+                await batches.aclose()
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
 
     # Get a profile data for http
-    async def get(self, uuid: str, request: Request=None) -> APIRouter:
-        if settings.cloud_provider == "aws":
-            profile = await self.profile_repo.get(uuid)
-            ## check if profile exists
-            if 'Item' not in profile:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
-            ## create response
-            return profile['Item']
-        elif settings.cloud_provider == "local":
-            ttl = await self.profile_repo.getTtl(uuid)
-            ## check if request header has if-none-match & return 304 not modified
-            if request:
-                if request.headers.get("if-none-match") == "W/"+uuid and ttl > 0:
-                    return Response(status_code=304, headers={"Cache-Control": f"max-age={ttl}"})
-            ## check if profile is cached
-            profile = await self.profile_repo.getCache(uuid)
-            if profile:
-                ## create response
-                response = JSONResponse(content=ujson.loads(profile))
-                ## add cache hit headers
-                response.headers["X-Cache"] = "HIT"
-                ttl = await self.profile_repo.getTtl(uuid)
-                response.headers["Cache-Control"] = f"max-age={ttl}"
-                response.headers["Expires"] = str(ttl)
-                response.headers["Etag"] = "W/"+uuid
-                return response
-            ## if profile is not cached, get profile db
-            profile = await self.profile_repo.get(uuid)
-            if not profile:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
-            ## remove _id
-            profile.pop("_id")
-            ## cache profile
-            await self.profile_repo.setCache(uuid, ujson.dumps(profile))
-            ## create response
-            response = JSONResponse(content=profile)
+    async def get(self, uuid: str, request: Request=None, fields: str | None = None) -> APIRouter:
+        fields = parse_fields(fields)
+        if_none_match = request.headers.get("if-none-match") if request else None
+        ## answer if-none-match from the cached version alone, without fetching the body
+        if if_none_match:
+            version, ttl = await self.profile_repo.getCacheVersion(uuid)
+            if version and etag_matches(if_none_match, make_etag(uuid, version, fields)):
+                return Response(status_code=304, headers={"Cache-Control": f"max-age={ttl}", "ETag": make_etag(uuid, version, fields)})
+        ## get the serialized profile (or fieldset) from cache, or from db once per uuid across concurrent requests
+        entry, hit = await self.profile_repo.getEntry(uuid, fields)
+        if not entry:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+        etag = make_etag(uuid, entry.version, fields)
+        if not hit:
+            if if_none_match and etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            ## create response from the same bytes written to the cache
+            response = entry_response(entry, request)
             ## add cache miss headers
             response.headers["X-Cache"] = "MISS"
+            response.headers["ETag"] = etag
             return response
-    
-    # Create a profile data
-    async def post(self, profile: ProfileCreate) -> APIRouter:
-        ## check data integrity
-        if await self.profile_repo.isConflict(profile):
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
+        ## with stale-while-revalidate, clients may cache until the soft expiry only
+        ttl = entry.ttl
+        if entry.soft is not None:
+            ttl = max(0, min(ttl, int(entry.soft - time.time())))
+        ## create response from the cached bytes as is
+        response = entry_response(entry, request)
+        ## add cache hit headers
+        response.headers["X-Cache"] = "HIT"
+        response.headers["Cache-Control"] = f"max-age={ttl}"
+        response.headers["Expires"] = str(ttl)
+        response.headers["ETag"] = etag
+        return response
+
+    # Get many profiles by uuid, in request order with a status for each of them
+    async def getMany(self, uuids: list[str], fields: tuple[str, ...] | None = None) -> Response:
+        self.checkBatch(uuids)
+        entries = await self.profile_repo.getEntries(uuids, fields)
+        ## embed the cached bytes as is
+        results = [{"uuid": uuid, "status": status.HTTP_200_OK, "data": orjson.Fragment(entries[uuid].body)} if entries[uuid] else {"uuid": uuid, "status": status.HTTP_404_NOT_FOUND, "data": None} for uuid in uuids]
+        return Response(content=orjson.dumps(results), media_type="application/json")
+
+    # Get many profiles by uuid, from a body for lists too long for a query string
+    async def postMany(self, uuids: list[str] = Body(), fields: str | None = None) -> Response:
+        return await self.getMany(uuids, parse_fields(fields))
+
+    # Check if-match against the current version, returning the matched version
+    async def checkIfMatch(self, uuid: str, request: Request=None) -> str | None:
+        if_match = request.headers.get("if-match") if request else None
+        if not if_match:
+            return None
+        ## the cached version is preferred over a datastore read
+        version = await self.profile_repo.getVersion(uuid)
+        if not version:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+        if not etag_matches(if_match, make_etag(uuid, version), weak=False):
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Profile has been modified")
+        return version
+
+    # Create a profile data, a used email is rejected by the datastore (409) in the same round trip
+    async def post(self, profile: ProfileCreate, response: Response=None) -> APIRouter:
         profile.uuid = str(uuid4())
         if profile.birthdate:
             profile.birthdate = profile.birthdate.isoformat()
         profile.updatedAt = datetime.now().isoformat()
         profile.createdAt = datetime.now().isoformat()
         # log.debug("Profile Service: %s", profile)
-        if settings.cloud_provider == "aws":
-            profile = await self.profile_repo.create(profile)
-        elif settings.cloud_provider == "local":
-            await self.profile_repo.create(profile.model_dump())
+        profile = await self.profile_repo.create(profile)
         # log.debug("Profile Service: %s", profile)
+        if response:
+            response.headers["ETag"] = make_etag(profile.uuid, profile.updatedAt)
         return profile
 
-    # Update a profile data
-    async def put(self, uuid: str, profile: ProfileUpdate) -> APIRouter:
-        ## check if profile exists
-        if not await self.profile_repo.isExist(uuid):
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    # Update a profile data, a missing profile is reported (404) by the update itself
+    async def put(self, uuid: str, profile: ProfileUpdate, request: Request=None, response: Response=None) -> APIRouter:
+        ## check if-match
+        version = await self.checkIfMatch(uuid, request)
         ## convert birthdate to isoformat
         if profile.birthdate:
             profile.birthdate = profile.birthdate.isoformat()
         profile.updatedAt = datetime.now().isoformat()
-        if settings.cloud_provider == "aws":
-            ## update profile
-            await self.profile_repo.update(uuid, profile)
-            profile = await self.profile_repo.get(uuid)
-            # log.debug("Profile Service: %s", profile)
-            return profile["Item"]
-        elif settings.cloud_provider == "local":
-            await self.profile_repo.update(uuid, profile.model_dump(exclude_unset=True))
-            ## delete profile cache
-            await self.profile_repo.deleteCache(uuid)
-            profile = await self.profile_repo.get(uuid)
-            return profile
-
-    # Delete a profile data
-    async def delete(self, uuid: str):
-        ## check if profile exists
-        if not await self.profile_repo.isExist(uuid):
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
-        ## delete profile cache
-        await self.profile_repo.deleteCache(uuid)
-        ## delete profile
-        await self.profile_repo.delete(uuid)
+        if response:
+            response.headers["ETag"] = make_etag(uuid, profile.updatedAt)
+        ## update profile and get it back in one round trip, which also refreshes its cache
+        profile = await self.profile_repo.update(uuid, profile, version)
+        # log.debug("Profile Service: %s", profile)
+        return profile
+
+    # Delete a profile data, a missing profile is reported (404) by the delete itself
+    async def delete(self, uuid: str, request: Request=None):
+        ## check if-match
+        version = await self.checkIfMatch(uuid, request)
+        ## delete profile and its cache
+        await self.profile_repo.delete(uuid, version)
+
+    # Check the size of a batch request
+    def checkBatch(self, items: list):
+        if len(items) > settings.batch_max_items:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Batch exceeds {settings.batch_max_items} items")
+
+    # Create profiles in bulk, with a status for each of them
+    async def postBatch(self, profiles: list[ProfileCreate]) -> list[BatchResult]:
+        self.checkBatch(profiles)
+        ## check data integrity of the whole batch in one query
+        taken = await self.profile_repo.conflicts([profile.email for profile in profiles])
+        results, accepted = [None] * len(profiles), []
+        now = datetime.now().isoformat()
+        for index, profile in enumerate(profiles):
+            if profile.email in taken:
+                results[index] = BatchResult(status=status.HTTP_409_CONFLICT, detail="Profile email already exist")
+                continue
+            ### an email appearing twice in the batch is created once
+            taken.add(profile.email)
+            profile.uuid = str(uuid4())
+            if profile.birthdate:
+                profile.birthdate = profile.birthdate.isoformat()
+            profile.updatedAt = now
+            profile.createdAt = now
+            accepted.append(index)
+        statuses = await self.profile_repo.createMany([profiles[index] for index in accepted])
+        for index, code in zip(accepted, statuses):
+            results[index] = BatchResult(uuid=profiles[index].uuid, status=code, detail=batch_details.get(code))
+        return results
+
+    # Update profiles in bulk, with a status for each of them
+    async def putBatch(self, profiles: list[ProfileBatchUpdate]) -> list[BatchResult]:
+        self.checkBatch(profiles)
+        found = await self.profile_repo.existing([profile.uuid for profile in profiles])
+        results, accepted = [None] * len(profiles), []
+        now = datetime.now().isoformat()
+        for index, profile in enumerate(profiles):
+            if profile.uuid not in found:
+                results[index] = BatchResult(uuid=profile.uuid, status=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+                continue
+            if profile.birthdate:
+                profile.birthdate = profile.birthdate.isoformat()
+            profile.updatedAt = now
+            accepted.append(index)
+        ## update profiles, which invalidates their cache
+        statuses = await self.profile_repo.updateMany([(profiles[index].uuid, profiles[index]) for index in accepted])
+        for index, code in zip(accepted, statuses):
+            results[index] = BatchResult(uuid=profiles[index].uuid, status=code, detail=batch_details.get(code))
+        return results
+
+    # Delete profiles in bulk, with a status for each of them
+    async def deleteBatch(self, uuids: list[str] = Body()) -> list[BatchResult]:
+        self.checkBatch(uuids)
+        found = await self.profile_repo.existing(uuids)
+        ## delete profiles and their cache
+        await self.profile_repo.deleteMany([uuid for uuid in uuids if uuid in found])
+        return [BatchResult(uuid=uuid, status=status.HTTP_204_NO_CONTENT) if uuid in found else BatchResult(uuid=uuid, status=status.HTTP_404_NOT_FOUND, detail="Profile not found") for uuid in uuids]
+
+    # cache and service counters
+    async def metrics(self):
+        return metrics.snapshot()
 
     # health check
     async def health(self):
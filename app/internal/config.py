@@ -27,7 +27,72 @@ class Settings(BaseSettings):
     redis_port: int = 6379
     redis_db: int = 0
     redis_pass: str = "pass"
-    redis_ttl: int = 3600
+    redis_ttl: int = 3600 #second, hard expiry of a cached profile
+
+    ## Profile cache store: "redis" or "memory" (per process)
+    cache_backend: str = "redis"
+    cache_memory_size: int = 10000 #entries
+    cache_negative_ttl: int = 30 #second, how long a missing profile is remembered
+
+    ## Stale-while-revalidate
+    cache_swr_enabled: bool = False
+    redis_soft_ttl: int = 600 #second, soft expiry after which a cached profile is refreshed in background
+    cache_xfetch_beta: float = 1.0 #higher refreshes earlier
+
+    ## L1 in-process cache in front of Redis
+    l1_cache_enabled: bool = False
+    l1_cache_size: int = 1024 #entries
+    l1_cache_ttl: int = 5 #second
+    l1_cache_channel: str = "profile:invalidate"
+
+    ## Cache fill lock shared across replicas
+    cache_lock_enabled: bool = False
+    cache_lock_ttl: int = 5000 #millisecond
+    cache_lock_wait: int = 1000 #millisecond
+
+    ## Circuit breaker around the redis cache, reads miss and writes are dropped while it is open
+    cache_breaker_enabled: bool = True
+    cache_timeout: int = 100 #millisecond, a slower cache call is a failure
+    cache_breaker_window: int = 20 #calls, the failure rate is measured over the last calls
+    cache_breaker_min_calls: int = 10 #calls before the failure rate is considered
+    cache_breaker_failure_rate: float = 0.5
+    cache_breaker_reset_timeout: float = 5.0 #second, open before probing
+    cache_breaker_probes: int = 3 #successful probes closing the breaker
+    cache_breaker_stale_size: int = 10000 #failed invalidations remembered and retried in the background
+    cache_invalidation_backoff: int = 100 #millisecond, base of the exponential backoff between the retries of failed invalidations
+    cache_invalidation_backoff_max: int = 5000 #millisecond
+
+    ## Index reconciliation at startup: "warn" logs drift, "fail" stops the startup, "off" skips it
+    index_policy: str = "warn"
+
+    ## Micro-batching of concurrent cache and datastore reads of single profiles
+    read_batch_enabled: bool = False
+    read_batch_window: float = 1.0 #millisecond
+    read_batch_size: int = 100 #keys
+
+    ## Connection pools, one per client and shared by the whole process
+    db_pool_size: int = 100 #connections (mongo maxPoolSize, dynamodb max_pool_connections)
+    db_pool_min: int = 0 #connections kept open by mongo
+    db_pool_timeout: float = 2.0 #second, wait for a free connection (mongo)
+    db_pool_idle_timeout: int = 60 #second, idle connections are closed past it
+    db_connect_timeout: float = 5.0 #second
+    db_socket_keepalive: bool = True #tcp keepalive (dynamodb, always on for mongo)
+    redis_pool_size: int = 50 #connections
+    redis_pool_timeout: float = 2.0 #second, wait for a free connection
+    redis_connect_timeout: float = 5.0 #second
+    redis_socket_keepalive: bool = True
+    redis_health_check_interval: int = 30 #second, idle connections are checked before reuse past it
+    redis_socket_timeout: float = 5.0 #second, upper bound of a command, whatever the deadline of the request
+    pool_warmup: int = 10 #connections opened per pool before serving
+    pool_warmup_timeout: float = 5.0 #second, the service starts anyway past it or if a backend is down
+
+    ## Read routing, reads of a client (and of a profile) go to the primary for the window after a write
+    mongo_read_preference_scan: str = "secondaryPreferred" #list, export and multi-get: primary, primaryPreferred, secondary, secondaryPreferred or nearest
+    mongo_read_preference_get: str = "secondaryPreferred" #single get
+    mongo_max_staleness: int = 90 #second, at least 90, -1 for no bound (primary reads only)
+    dynamodb_consistent_scan: bool = False #strongly consistent list, export and multi-get
+    dynamodb_consistent_get: bool = False #strongly consistent single get
+    read_your_writes_window: int = 90 #second, at least mongo_max_staleness when reading from secondaries
 
     # Cloud Provider
     cloud_provider: str = "local"
@@ -39,12 +104,17 @@ class Settings(BaseSettings):
     profile_session_name: str = "ols_svc_profile"
     ## DynamoDB
     dynamodb_table: str = "profile"
+    dynamodb_email_table: str = "profile-email" #email guard items (key: email), keeping emails unique
+    dynamodb_batch_retries: int = 5 #retries of the keys left unprocessed by a BatchGetItem, 503 past them
+    dynamodb_batch_backoff: int = 50 #millisecond, base of the exponential backoff between the retries
+    dynamodb_batch_backoff_max: int = 1000 #millisecond
 
     # GCP
     ## Firestore
     firestore_project_id: str = "ols-platform-dev"
     firestore_database: str = "(default)"
     firestore_collection: str = "sample"
+    firestore_email_collection: str = "sample-email" #email guard documents, keeping emails unique
 
     # Middleware
     ## Cors
@@ -60,9 +130,46 @@ class Settings(BaseSettings):
     ## GZipMiddleware
     gzip_min_length: int = 512
 
-    # Rate Limit Config
+    ## Pre-compressed cache entries, served as is to the clients accepting them, the gzip middleware compressing the others
+    cache_encodings: str = "" #content codings stored with the cached profiles in order of preference, e.g. "br,zstd,gzip", empty to disable
+    cache_gzip_level: int = 6
+    cache_brotli_level: int = 5 #requires the brotli package
+    cache_zstd_level: int = 3 #requires the zstandard package
+
+    ## LoggingMiddleware, errors and slow requests are always logged
+    log_sample_rate: float = 1.0 #share of the successful requests logged
+    log_slow_threshold: int = 1000 #millisecond
+    log_request_headers: str = "host,user-agent,content-type,content-length,x-request-id,x-forwarded-for"
+    log_response_headers: str = "content-type,content-length,x-cache,etag"
+    log_format: str = "json" #json or text
+    log_queue_size: int = 10000 #records, dropped when full
+    log_batch_size: int = 256 #records written per flush
+
+    # Pagination
+    cursor_secret: str = "change-me" #signs the opaque list cursors
+
+    # Export
+    export_batch_size: int = 500 #profiles per datastore round trip and per checkpoint
+    export_segments: int = 4 #parallel scan segments (DynamoDB)
+
+    # Batch
+    batch_max_items: int = 500 #items per batch request
+
+    # Deadlines, overridden per request by the X-Request-Timeout header (millisecond)
+    request_timeout: int = 2000 #millisecond
+    request_timeout_batch: int = 10000 #millisecond, batch and multi-get requests
+    request_timeout_max: int = 30000 #millisecond, cap of the header
+
+    # Rate Limit Config, token buckets of `times` requests refilled over `seconds`, per route and client
     rate_limit_times: int = 20 #times
     rate_limit_seconds: int = 60 #second
+    rate_limit_routes: str = "" #per route limits, e.g. "postBatch=5/60,export=1/60"
+    rate_limit_api_keys: str = "" #per api key limits on every route, e.g. "key1=1000/60,key2=100/60"
+    rate_limit_api_key_header: str = "x-api-key"
+    rate_limit_distributed: bool = True #reconcile the buckets of the workers through redis
+    rate_limit_sync_interval: int = 500 #millisecond
+    rate_limit_sync_timeout: int = 100 #millisecond
+    rate_limit_tolerance: float = 0.1 #share of a limit a worker admits before syncing early
 
     # Loading .env file if present
     class Config:
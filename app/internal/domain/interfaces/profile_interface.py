@@ -1,16 +1,50 @@
 # Path: ols_svc_sample/app/internal/domain/interfaces/profile_interface.py
 
+from __future__ import annotations
 from abc import ABC, abstractmethod
+from typing import AsyncIterator
 from fastapi import HTTPException
 from ..models.profile import Profile, ProfileCreate, ProfileUpdate
 
+# Status of an item of a batch written concurrently, from its result or the exception it raised (gather with return_exceptions)
+def batch_status(result, ok: int = 200) -> int:
+    if isinstance(result, HTTPException):
+        return result.status_code
+    if isinstance(result, BaseException):
+        return 500
+    return ok
+
 class ProfileInterface(ABC):
     @abstractmethod
-    async def list(self, skip: int = 0, limit: int = 10) -> list:
+    async def isExist(self, _id: str) -> bool:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def isConflict(self, entity: ProfileCreate) -> bool:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def list(self, skip: int = 0, limit: int = 10, fields: tuple[str, ...] | None = None) -> list:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def listAfter(self, after: str | None = None, limit: int = 10, fields: tuple[str, ...] | None = None) -> tuple[list, str | None]:
         raise HTTPException(status_code=501, detail="Not Implemented")
 
     @abstractmethod
-    async def get(self, _id: str) -> Profile:
+    def export(self, checkpoint: str | None = None) -> AsyncIterator[tuple[list, str]]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def get(self, _id: str, fields: tuple[str, ...] | None = None) -> Profile:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def getMany(self, ids: list[str], fields: tuple[str, ...] | None = None) -> dict[str, Profile]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def getVersion(self, _id: str) -> str | None:
         raise HTTPException(status_code=501, detail="Not Implemented")
 
     @abstractmethod
@@ -18,9 +52,29 @@ class ProfileInterface(ABC):
         raise HTTPException(status_code=501, detail="Not Implemented")
 
     @abstractmethod
-    async def update(self, _id: str, entity: ProfileUpdate) -> Profile:
+    async def update(self, _id: str, entity: ProfileUpdate, version: str | None = None) -> Profile:
         raise HTTPException(status_code=501, detail="Not Implemented")
 
     @abstractmethod
-    async def delete(self, _id: str):
-        raise HTTPException(status_code=501, detail="Not Implemented")
\ No newline at end of file
+    async def delete(self, _id: str, version: str | None = None):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def existing(self, ids: list[str]) -> set[str]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def conflicts(self, emails: list[str]) -> set[str]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def createMany(self, entities: list[ProfileCreate]) -> list[int]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def updateMany(self, entities: list[tuple[str, ProfileUpdate]]) -> list[int]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def deleteMany(self, ids: list[str]):
+        raise HTTPException(status_code=501, detail="Not Implemented")
@@ -1,7 +1,8 @@
 # Path: ols_svc_sample/app/internal/domain/models/profile.py
 
 from datetime import date, datetime
-from pydantic import BaseModel
+from functools import lru_cache
+from pydantic import BaseModel, TypeAdapter, create_model
 
 # http
 ## Image
@@ -32,6 +33,24 @@ class Profile(BaseModel):
     createdAt: datetime | None = None
     updatedAt: datetime | None = None
 
+## ProfilePage
+class ProfilePage(BaseModel):
+    data: list[Profile]
+    next_cursor: str | None = None
+
+## Profile narrowed to a sparse fieldset (?fields=), so partial profiles validate and serialize without the other fields
+@lru_cache(maxsize=128)
+def narrow_profile(fields: tuple[str, ...]) -> type[BaseModel]:
+    return create_model("ProfileFields", **{name: (Profile.model_fields[name].annotation, Profile.model_fields[name]) for name in fields})
+
+@lru_cache(maxsize=128)
+def narrow_profile_list(fields: tuple[str, ...]) -> TypeAdapter:
+    return TypeAdapter(list[narrow_profile(fields)])
+
+@lru_cache(maxsize=128)
+def narrow_profile_page(fields: tuple[str, ...]) -> type[BaseModel]:
+    return create_model("ProfilePageFields", data=(list[narrow_profile(fields)], ...), next_cursor=(str | None, None))
+
 ## ProfileCreate
 class ProfileCreate(BaseModel):
     uuid: str | None = None
@@ -56,4 +75,20 @@ class ProfileUpdate(BaseModel):
     addresses: list[Address] | None = None
     image: Image | None = None
     createdAt: datetime | None = None
-    updatedAt: datetime | None = None
\ No newline at end of file
+    updatedAt: datetime | None = None
+
+## ProfileBatchUpdate, an item of a batch update
+class ProfileBatchUpdate(ProfileUpdate):
+    uuid: str
+
+## BatchResult, the outcome of an item of a batch request
+class BatchResult(BaseModel):
+    uuid: str | None = None
+    status: int
+    detail: str | None = None
+
+## ProfileResult, the outcome of a profile of a multi-get request
+class ProfileResult(BaseModel):
+    uuid: str
+    status: int
+    data: Profile | None = None
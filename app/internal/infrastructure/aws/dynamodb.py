@@ -1,8 +1,18 @@
 # Path: ols_svc_sample/app/internal/infrastructure/aws/dynamodb.py
 
-import boto3
+import asyncio, boto3
+from botocore.exceptions import ClientError
 from ....internal.config import get_settings
 from .sts import get_aws_credentials
+from ..indexes import Index
+
+# Global secondary indexes of the profile table, provisioned outside the service: isConflict by email
+PROFILE_INDEXES = [
+    Index("email-index", (("email", "HASH"),)),
+]
+
+# Key of the email guard table, provisioned outside the service: one item per email keeps emails unique
+EMAIL_GUARD_KEY = Index("email", (("email", "HASH"),), unique=True)
 # from ...infrastructure.logger import log
 
 class DynamoDB:
@@ -28,4 +38,46 @@ class DynamoDB:
             )
             table = self.client.Table(self.settings.dynamodb_table)
             # log.debug(f"DynamoDb Table: {table}")
-            return table
\ No newline at end of file
+            return table
+
+# Check the email guard table exists and holds the guards of a sample of the profiles, read consistently
+async def check_email_guards(table, emails, sample: int = 25) -> list[str]:
+    try:
+        await emails.table_status
+    except ClientError as e:
+        return [f"email guard table {emails.name} is missing ({e.response['Error']['Code']})"]
+    response = await table.scan(Limit=sample, ProjectionExpression="#uuid, email", ExpressionAttributeNames={"#uuid": "uuid"})
+    items = response.get("Items", [])
+    guards = await asyncio.gather(*(emails.get_item(Key={"email": item["email"]}, ConsistentRead=True) for item in items))
+    missing = [item["uuid"] for item, guard in zip(items, guards) if "Item" not in guard]
+    return [f"{len(missing)} of {len(items)} sampled profiles have no email guard item, e.g. {missing[0]}"] if missing else []
+
+# Check the key schema of a table, and that it is active
+async def check_key(table, key: Index) -> list[str]:
+    try:
+        schema, state = await table.key_schema, await table.table_status
+    except ClientError as e:
+        return [f"table {table.name} is missing ({e.response['Error']['Code']})"]
+    problems = []
+    keys = tuple((current["AttributeName"], current["KeyType"]) for current in schema)
+    if keys != key.keys:
+        problems.append(f"table {table.name} is keyed by {list(keys)} instead of {list(key.keys)}")
+    if state != "ACTIVE":
+        problems.append(f"table {table.name} is {state}")
+    return problems
+
+# Check the declared global secondary indexes exist, match and are active
+async def check_indexes(table, indexes: list[Index]) -> list[str]:
+    existing = {gsi["IndexName"]: gsi for gsi in (await table.global_secondary_indexes or [])}
+    problems = []
+    for index in indexes:
+        current = existing.get(index.name)
+        if current is None:
+            problems.append(f"global secondary index {index.name} is missing")
+            continue
+        keys = tuple((key["AttributeName"], key["KeyType"]) for key in current["KeySchema"])
+        if keys != index.keys:
+            problems.append(f"{index.name} is {list(keys)} instead of {list(index.keys)}")
+        if current.get("IndexStatus") != "ACTIVE":
+            problems.append(f"{index.name} is {current.get('IndexStatus')}")
+    return problems
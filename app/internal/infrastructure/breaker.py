@@ -0,0 +1,95 @@
+# Path: ols_svc_sample/app/internal/infrastructure/breaker.py
+
+import asyncio, time
+from collections import deque
+from .logger import log
+from .metrics import metrics
+
+class CircuitBreaker:
+    # Count-based circuit breaker: opens once the failure rate over the last `window` calls reaches `failure_rate`,
+    # lets `probes` calls through after `reset_timeout` seconds (half-open) and closes once they all succeed;
+    # a call taking longer than `timeout` seconds is a failure
+    def __init__(self, name: str, window: int = 20, min_calls: int = 10, failure_rate: float = 0.5, reset_timeout: float = 5.0, probes: int = 1, timeout: float = 0.1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.timeout = timeout
+        self.state = "closed"
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probing = 0
+        self.probed = 0
+        self.on_close = []
+        metrics.register(f"{name}_breaker", self.snapshot)
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "calls": len(self.outcomes), "failures": self.outcomes.count(False)}
+
+    ## Run fn, or return the fallback without calling it while open; a failing call returns the fallback too
+    async def call(self, fn, fallback=None):
+        if not self.allow():
+            metrics.incr(f"{self.name}_breaker_rejected")
+            return fallback
+        probe = self.state == "half_open"
+        try:
+            result = await asyncio.wait_for(fn(), self.timeout)
+        except asyncio.CancelledError:
+            ### cancelled by the caller (e.g. its deadline), which says nothing about the backend
+            self.record(None, probe)
+            raise
+        except Exception as e:
+            log.debug(f"{self.name} call failed: {e!r}")
+            metrics.incr(f"{self.name}_errors")
+            self.record(False, probe)
+            return fallback
+        self.record(True, probe)
+        return result
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.transition("half_open")
+        if self.state == "half_open":
+            if self.probing + self.probed >= self.probes:
+                return False
+            self.probing += 1
+        return True
+
+    def record(self, success: bool | None, probe: bool):
+        ### outcomes of calls started before the last transition are not counted in the new state
+        if probe:
+            if self.state != "half_open":
+                return
+            self.probing -= 1
+            if success is None:
+                return
+            if not success:
+                self.transition("open")
+                return
+            self.probed += 1
+            if self.probed >= self.probes:
+                self.transition("closed")
+            return
+        if self.state != "closed" or success is None:
+            return
+        self.outcomes.append(success)
+        if len(self.outcomes) >= self.min_calls and self.outcomes.count(False) / len(self.outcomes) >= self.failure_rate:
+            self.transition("open")
+
+    def transition(self, state: str):
+        self.state = state
+        self.probing = self.probed = 0
+        if state == "open":
+            self.opened_at = time.monotonic()
+            metrics.incr(f"{self.name}_breaker_opened")
+            log.warning(f"{self.name} circuit breaker is open, retrying in {self.reset_timeout} seconds")
+        elif state == "half_open":
+            log.info(f"{self.name} circuit breaker is half-open, probing")
+        else:
+            self.outcomes.clear()
+            log.info(f"{self.name} circuit breaker is closed")
+            for callback in self.on_close:
+                callback()
@@ -0,0 +1,58 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/batcher.py
+
+import asyncio, contextvars
+from ..metrics import metrics
+
+class Batcher:
+    # Collect the keys loaded concurrently within a window, or up to size keys,
+    # into a single call of fn(keys) returning {key: value}
+    def __init__(self, name: str, fn, window: float = 0.001, size: int = 100):
+        self.name = name
+        self.fn = fn
+        self.window = window
+        self.size = size
+        self._pending = {}
+        self._timer = None
+        self._running = set()
+
+    ## Load the value of key, along with the other keys of the current batch
+    async def load(self, key):
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+            if len(self._pending) >= self.size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush)
+        ### a cancelled caller does not cancel the other waiters of the batch
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            ### keep a reference so the task is not garbage collected while running; the batch is shared,
+            ### it runs in a context of its own rather than with the deadline of the caller that filled it
+            task = asyncio.create_task(self._run(batch), context=contextvars.Context())
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: dict):
+        metrics.incr(f"{self.name}_batches")
+        metrics.incr(f"{self.name}_batched_keys", len(batch))
+        try:
+            values = await self.fn(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    ### do not report the error as unretrieved when every waiter is gone
+                    future.add_done_callback(lambda done: done.exception())
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(values.get(key))
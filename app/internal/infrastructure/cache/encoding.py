@@ -0,0 +1,60 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/encoding.py
+
+import gzip
+from ....internal.config import get_settings
+
+settings = get_settings()
+
+## brotli and zstd are optional, their variants are only created when the package is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressors by content coding, of the codings available in this process
+codecs = {"gzip": lambda body: gzip.compress(body, compresslevel=settings.cache_gzip_level, mtime=0)}
+if brotli:
+    codecs["br"] = lambda body: brotli.compress(body, quality=settings.cache_brotli_level)
+if zstandard:
+    codecs["zstd"] = lambda body: zstandard.ZstdCompressor(level=settings.cache_zstd_level).compress(body)
+
+# Content codings stored with the cache entries, in order of preference
+def encodings() -> tuple[str, ...]:
+    return tuple(name for name in (name.strip() for name in settings.cache_encodings.split(",")) if name in codecs)
+
+# Compressed variants of a serialized body, keyed by content coding, none for bodies too small to be worth it
+def compress(body: bytes | None) -> dict[str, bytes] | None:
+    if not body or len(body) < settings.gzip_min_length:
+        return None
+    return {name: codecs[name](body) for name in encodings()} or None
+
+# Pick the variant accepted by the client, in the order of preference of the server; returns (coding, body)
+def negotiate(accept_encoding: str | None, variants: dict[str, bytes] | None) -> tuple[str | None, bytes | None]:
+    if not accept_encoding or not variants:
+        return None, None
+    accepted, wildcard = {}, None
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        ### q-values are the only parameter, a malformed one refuses the coding
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        name = name.strip().lower()
+        if name == "*":
+            wildcard = q
+        elif name:
+            accepted[name] = q
+    for name, body in variants.items():
+        q = accepted.get(name, wildcard)
+        if q:
+            return name, body
+    return None, None
@@ -0,0 +1,28 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/entry.py
+
+import math, random, time
+from typing import NamedTuple
+
+class CacheEntry(NamedTuple):
+    # A cached profile: serialized body, version, remaining (hard) ttl,
+    # soft expiry in epoch seconds, the seconds its last fill took,
+    # whether it records a profile that does not exist
+    # the sparse fieldset held by the body (None for the whole profile)
+    # whether it records a profile written within the read-your-writes window
+    # and the compressed variants of the body keyed by content coding (whole profiles only)
+    body: bytes | None = None
+    version: str | None = None
+    ttl: int = -2
+    soft: float | None = None
+    delta: float = 0.0
+    missing: bool = False
+    fields: tuple[str, ...] | None = None
+    written: bool = False
+    variants: dict[str, bytes] | None = None
+
+    ## XFetch: refresh once past the soft expiry, or probabilistically earlier
+    ## the longer the fill takes, so hot keys do not all expire in lockstep
+    def shouldRefresh(self, beta: float = 1.0) -> bool:
+        if self.body is None or self.soft is None:
+            return False
+        return time.time() - self.delta * beta * math.log(1.0 - random.random()) >= self.soft
@@ -0,0 +1,130 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/guarded.py
+
+import asyncio, random
+from ..breaker import CircuitBreaker
+from ..logger import log
+from .entry import CacheEntry
+from .store import CacheStore
+from ....internal.config import get_settings
+
+settings = get_settings()
+
+class GuardedCacheStore(CacheStore):
+    # Cache store behind a circuit breaker: while the cache is failing or slow, reads miss (and go to the datastore),
+    # writes are dropped, and the invalidations that could not be applied are retried in the background until they are,
+    # until then the profiles they concern are read from the datastore
+    def __init__(self, store: CacheStore):
+        self.store = store
+        self.breaker = CircuitBreaker(
+            "cache",
+            window=settings.cache_breaker_window,
+            min_calls=settings.cache_breaker_min_calls,
+            failure_rate=settings.cache_breaker_failure_rate,
+            reset_timeout=settings.cache_breaker_reset_timeout,
+            probes=settings.cache_breaker_probes,
+            timeout=settings.cache_timeout / 1000,
+        )
+        self.breaker.on_close.append(self.replay)
+        self.stale = set()
+        self.retrying = None
+        self.wake = asyncio.Event()
+
+    async def getEntry(self, id: str, fields: tuple[str, ...] | None = None) -> CacheEntry:
+        if id in self.stale:
+            return CacheEntry()
+        return await self.breaker.call(lambda: self.store.getEntry(id, fields), CacheEntry())
+
+    async def getEntries(self, ids: list[str]) -> dict[str, CacheEntry]:
+        ids = [id for id in ids if id not in self.stale]
+        return await self.breaker.call(lambda: self.store.getEntries(ids), {}) if ids else {}
+
+    async def getVersion(self, id: str) -> tuple[str | None, int]:
+        if id in self.stale:
+            return None, -2
+        return await self.breaker.call(lambda: self.store.getVersion(id), (None, -2))
+
+    ## an entry set or deleted since replaces the one an invalidation could not drop
+    async def setEntry(self, id: str, body: bytes, version: str, delta: float = 0.0, fields: tuple[str, ...] | None = None, variants: dict[str, bytes] | None = None):
+        if await self.breaker.call(lambda: self.store.setEntry(id, body, version, delta, fields, variants), False) is not False and not fields:
+            self.stale.discard(id)
+
+    async def setEntries(self, entries: dict[str, CacheEntry], delta: float = 0.0):
+        if await self.breaker.call(lambda: self.store.setEntries(entries, delta), False) is not False:
+            self.stale.difference_update(entries)
+
+    ## a datum that could not be replaced may be cached at its previous version, it is invalidated later
+    async def replaceEntry(self, id: str, body: bytes, version: str, variants: dict[str, bytes] | None = None):
+        if await self.breaker.call(lambda: self.store.replaceEntry(id, body, version, variants), False) is False:
+            self.invalidateLater([id])
+        else:
+            self.stale.discard(id)
+
+    async def setMissing(self, id: str):
+        if await self.breaker.call(lambda: self.store.setMissing(id), False) is not False:
+            self.stale.discard(id)
+
+    async def deleteEntry(self, id: str):
+        if await self.breaker.call(lambda: self.store.deleteEntry(id), False) is False:
+            self.invalidateLater([id])
+        else:
+            self.stale.discard(id)
+
+    async def deleteEntries(self, ids: list[str]):
+        if await self.breaker.call(lambda: self.store.deleteEntries(ids), False) is False:
+            self.invalidateLater(ids)
+        else:
+            self.stale.difference_update(ids)
+
+    ## without the lock, the fill goes on as with a single replica
+    async def lock(self, id: str):
+        return await self.breaker.call(lambda: self.store.lock(id), True)
+
+    async def unlock(self, lock):
+        if lock is not True:
+            await self.breaker.call(lambda: self.store.unlock(lock))
+
+    ## Remember the invalidations that could not be applied, up to a bound, and retry them in the background
+    def invalidateLater(self, ids: list[str]):
+        ids = [id for id in ids if id not in self.stale]
+        room = settings.cache_breaker_stale_size - len(self.stale)
+        if len(ids) > room:
+            log.warning(f"{len(ids) - max(room, 0)} cache invalidations are dropped, their profiles may be served stale until they expire")
+        self.stale.update(ids[:max(room, 0)])
+        ### keep a reference so the task is not garbage collected while running
+        if self.stale and not self.retrying:
+            self.retrying = asyncio.create_task(self.retry())
+
+    ## Retry the remembered invalidations right away once the breaker closes
+    def replay(self):
+        self.wake.set()
+
+    ## Retry the remembered invalidations with capped exponential backoff and full jitter until they are all applied,
+    ## whatever the state of the breaker: a single failure usually leaves it closed
+    async def retry(self):
+        attempt = 0
+        try:
+            while self.stale:
+                delay = random.uniform(0, min(settings.cache_invalidation_backoff_max, settings.cache_invalidation_backoff * 2 ** attempt)) / 1000
+                ### asyncio.wait, unlike wait_for, never swallows the cancellation of the task when woken at the same time
+                waiter = asyncio.create_task(self.wake.wait())
+                try:
+                    await asyncio.wait((waiter,), timeout=delay)
+                finally:
+                    waiter.cancel()
+                self.wake.clear()
+                ids = list(self.stale)
+                if not ids:
+                    break
+                try:
+                    await asyncio.wait_for(self.store.deleteEntries(ids), self.breaker.timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    attempt += 1
+                    log.debug(f"{len(ids)} cache invalidations failed again: {e!r}")
+                    continue
+                self.stale.difference_update(ids)
+                attempt = 0
+                log.info(f"{len(ids)} cache invalidations are replayed")
+        finally:
+            self.retrying = None
@@ -0,0 +1,129 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/memory.py
+
+import asyncio, time
+from collections import OrderedDict
+from ..logger import log
+from .entry import CacheEntry
+from .store import CacheStore
+from ....internal.config import get_settings
+
+settings = get_settings()
+
+class MemoryCache:
+    # Bounded in-process LRU cache with a per-entry TTL
+    def __init__(self, maxsize: int = 1024, ttl: int = 5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    ## Get an entry as (value, expire_at), expire_at being the upstream (redis) expiry in epoch seconds
+    def get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, stale_at, expire_at = item
+        ### drop entries past their local ttl or their upstream expiry
+        if stale_at <= time.monotonic() or expire_at <= time.time():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return value, expire_at
+
+    ## Set an entry that lives at most `ttl` seconds locally and never past the upstream ttl
+    def set(self, key: str, value, upstream_ttl: int):
+        if upstream_ttl <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + min(self.ttl, upstream_ttl), time.time() + upstream_ttl)
+        self._data.move_to_end(key)
+        ### evict least recently used entries
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    ## Delete an entry
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    ## Drop every entry
+    def clear(self):
+        self._data.clear()
+
+class MemoryCacheStore(CacheStore):
+    # Per-process cache store, for single worker deployments or when no redis is available,
+    # each slot maps a fieldset (None for the whole profile) to its entry
+    def __init__(self, maxsize: int = 1024):
+        self.cache = MemoryCache(maxsize, settings.redis_ttl)
+
+    async def getEntry(self, id: str, fields: tuple[str, ...] | None = None) -> CacheEntry:
+        cached = self.cache.get(id)
+        if not cached:
+            return CacheEntry()
+        entries, expire_at = cached
+        entry = entries.get(fields) or entries.get(None) or CacheEntry()
+        return entry._replace(ttl=int(expire_at - time.time()))
+
+    async def getEntries(self, ids: list[str]) -> dict[str, CacheEntry]:
+        return {id: await self.getEntry(id) for id in ids}
+
+    async def getVersion(self, id: str) -> tuple[str | None, int]:
+        entry = await self.getEntry(id)
+        return entry.version, entry.ttl
+
+    async def setEntry(self, id: str, body: bytes, version: str, delta: float = 0.0, fields: tuple[str, ...] | None = None, variants: dict[str, bytes] | None = None):
+        if fields:
+            cached = self.cache.get(id)
+            if cached:
+                cached[0][fields] = CacheEntry(body, version, fields=fields)
+            else:
+                self.cache.set(id, {fields: CacheEntry(body, version, fields=fields)}, settings.redis_ttl)
+            return
+        entry = CacheEntry(body, version, settings.redis_ttl, variants=variants)
+        if settings.cache_swr_enabled:
+            entry = entry._replace(soft=time.time() + settings.redis_soft_ttl, delta=delta)
+        self.cache.set(id, {None: entry}, settings.redis_ttl)
+
+    async def setEntries(self, entries: dict[str, CacheEntry], delta: float = 0.0):
+        for id, entry in entries.items():
+            if entry.missing:
+                await self.setMissing(id)
+            else:
+                await self.setEntry(id, entry.body, entry.version, delta, variants=entry.variants)
+
+    async def replaceEntry(self, id: str, body: bytes, version: str, variants: dict[str, bytes] | None = None):
+        await self.setEntry(id, body, version, variants=variants)
+
+    async def setMissing(self, id: str):
+        self.cache.set(id, {None: CacheEntry(missing=True)}, settings.cache_negative_ttl)
+
+    async def deleteEntry(self, id: str):
+        self.cache.delete(id)
+        if settings.read_your_writes_window > 0:
+            self.cache.set(id, {None: CacheEntry(written=True)}, settings.read_your_writes_window)
+
+    async def deleteEntries(self, ids: list[str]):
+        for id in ids:
+            await self.deleteEntry(id)
+
+    ## fills are already coalesced per process, there is no other replica to lock out
+    async def lock(self, id: str):
+        return True
+
+    async def unlock(self, lock):
+        pass
+
+# Listen for cache invalidations published by other workers
+async def listen_invalidation(client, channel: str, cache: MemoryCache):
+    while True:
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                cache.delete(message["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ### invalidations may have been missed while disconnected
+            log.warning(f"L1 cache invalidation listener disconnected: {e}")
+            cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.reset()
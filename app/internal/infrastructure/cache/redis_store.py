@@ -0,0 +1,339 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/redis_store.py
+
+import time
+from datetime import timedelta
+from fastapi import HTTPException, status
+from ..logger import log
+from .entry import CacheEntry
+from .store import CacheStore
+from .batcher import Batcher
+from .encoding import encodings
+from ...adapter.event_handler import redis
+from ....internal.config import get_settings
+
+settings = get_settings()
+
+# Add the body of a fieldset and its own version to an entry, leaving the version and the ttl of the entry as they are;
+# a hash created by the fill gets the ttl of an entry
+SET_FIELDS_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+end
+return 1
+"""
+
+# Redis key of a cached profile entry (a hash, hence the v2 namespace)
+def cacheKey(id: str) -> str:
+    return f"profile:v2:{id}"
+
+# Hash fields of a cache entry, the compressed variants of the body following the others
+def entryFields() -> list[str]:
+    return ["body", "version", "soft", "delta", "missing", "written", *(encodedField(name) for name in encodings())]
+
+# Cache entry of the values of a hash, as read by HMGET of the entry fields
+def toEntry(values: list, ttl: int) -> CacheEntry:
+    value, version, soft, delta, missing, written, *encoded = values
+    variants = {name: body for name, body in zip(encodings(), encoded) if body} or None
+    return CacheEntry(value, version.decode() if version else None, ttl, float(soft) if soft else None, float(delta) if delta else 0.0, missing is not None, written=written is not None, variants=variants)
+
+# Hash fields of the compressed variants of the body, by content coding
+def encodedField(coding: str) -> str:
+    return f"encoded:{coding}"
+
+# Hash fields and values of the compressed variants, to be set along the body
+def encodedMapping(variants: dict[str, bytes] | None) -> dict:
+    return {encodedField(name): body for name, body in (variants or {}).items()}
+
+# Hash field of the body of a sparse fieldset, next to the body of the whole profile
+def bodyField(fields: tuple[str, ...] | None = None) -> str:
+    return "body:" + ",".join(fields) if fields else "body"
+
+# Hash field of the version of a sparse fieldset, which may have been read at another version than the whole profile
+def versionField(fields: tuple[str, ...] | None = None) -> str:
+    return "version:" + ",".join(fields) if fields else "version"
+
+class RedisCacheStore(CacheStore):
+    # Cache entries are redis hashes holding the serialized body, its version and its soft expiry,
+    # plus the bodies of sparse fieldsets, optionally fronted by the in-process L1 cache (whole profiles only)
+    def __init__(self):
+        ## lookups of whole profiles arriving together are read in one pipeline
+        self.reads = Batcher("cache_read", self.getEntries, settings.read_batch_window / 1000, settings.read_batch_size) if settings.read_batch_enabled else None
+
+    ## get datum, its version, its remaining ttl and its soft expiry from redis in one round trip
+    async def getEntry(self, id: str, fields: tuple[str, ...] | None = None) -> CacheEntry:
+        try:
+            ### get datum from the in-process L1 cache, a fieldset can be projected from it
+            if redis.get("l1"):
+                cached = redis["l1"].get(cacheKey(id))
+                if cached:
+                    log.debug(f"Profile datum is retrieved from L1 cache")
+                    entry, expire_at = cached
+                    return entry._replace(ttl=int(expire_at - time.time()))
+            if self.reads and not fields:
+                return await self.reads.load(id)
+            ### get datum and ttl atomically with a MULTI/EXEC pipeline
+            names = entryFields()
+            async with redis["client"].pipeline(transaction=True) as pipe:
+                values, ttl = await pipe.hmget(cacheKey(id), *names, *([bodyField(fields), versionField(fields)] if fields else [])).ttl(cacheKey(id)).execute()
+            entry, partial = toEntry(values[:len(names)], ttl), values[len(names):]
+            ### the body of the fieldset is preferred, with its own version, else the whole profile is returned for projection
+            if partial and partial[0]:
+                return CacheEntry(partial[0], partial[1].decode() if partial[1] else None, ttl, fields=fields)
+            if entry.body or entry.missing:
+                if redis.get("l1"):
+                    redis["l1"].set(cacheKey(id), entry, ttl)
+                log.debug(f"Profile datum is retrieved from Redis")
+            else:
+                log.debug(f"Profile datum is not retrieved from Redis")
+            return entry
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot get profile datum from Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## get many data, their versions, remaining ttls and soft expiries in one round trip, keyed by id
+    async def getEntries(self, ids: list[str]) -> dict[str, CacheEntry]:
+        try:
+            entries = {}
+            ### data held by the in-process L1 cache are not read from redis
+            if redis.get("l1"):
+                for id in ids:
+                    cached = redis["l1"].get(cacheKey(id))
+                    if cached:
+                        entry, expire_at = cached
+                        entries[id] = entry._replace(ttl=int(expire_at - time.time()))
+            ids = [id for id in dict.fromkeys(ids) if id not in entries]
+            if not ids:
+                return entries
+            ### a pipeline of HMGET and TTL per hash, MGET does not read hashes
+            names = entryFields()
+            async with redis["client"].pipeline(transaction=False) as pipe:
+                for id in ids:
+                    pipe.hmget(cacheKey(id), *names).ttl(cacheKey(id))
+                results = await pipe.execute()
+            for id, values, ttl in zip(ids, results[::2], results[1::2]):
+                entries[id] = entry = toEntry(values, ttl)
+                if (entry.body or entry.missing) and redis.get("l1"):
+                    redis["l1"].set(cacheKey(id), entry, ttl)
+            log.debug(f"{len(ids)} profile data are retrieved from Redis")
+            return entries
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot get profile data from Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## get only the cached version and its remaining ttl, without the body
+    async def getVersion(self, id: str) -> tuple[str | None, int]:
+        try:
+            if redis.get("l1"):
+                cached = redis["l1"].get(cacheKey(id))
+                if cached:
+                    entry, expire_at = cached
+                    return entry.version, int(expire_at - time.time())
+            async with redis["client"].pipeline(transaction=True) as pipe:
+                version, ttl = await pipe.hget(cacheKey(id), "version").ttl(cacheKey(id)).execute()
+            return version.decode() if version else None, ttl
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot get profile datum version from Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## set serialized datum and its version to redis with ttl, delta being the seconds the datum took to fetch
+    async def setEntry(self, id: str, body: bytes, version: str, delta: float = 0.0, fields: tuple[str, ...] | None = None, variants: dict[str, bytes] | None = None):
+        try:
+            ### add the body of a fieldset next to the others, it goes with the whole entry on invalidation;
+            ### the whole profile may be at another version, so the fieldset neither overwrites its version nor extends its ttl
+            if fields:
+                script = redis["client"].register_script(SET_FIELDS_SCRIPT)
+                await script(keys=[cacheKey(id)], args=[bodyField(fields), body, versionField(fields), version, settings.redis_ttl])
+                log.debug(f"Profile datum fields are set to Redis")
+                return
+            entry = CacheEntry(body, version, settings.redis_ttl, variants=variants)
+            ### the compressed variants are stored next to the body, replaced and expired with it
+            mapping = {"body": body, "version": version, **encodedMapping(variants)}
+            ### with stale-while-revalidate, the redis ttl is the hard expiry and the entry carries the soft one
+            if settings.cache_swr_enabled:
+                entry = entry._replace(soft=time.time() + settings.redis_soft_ttl, delta=delta)
+                mapping.update({"soft": entry.soft, "delta": delta})
+            ### replace the whole entry and set its ttl atomically
+            async with redis["client"].pipeline(transaction=True) as pipe:
+                _, _, is_cache = await pipe.delete(cacheKey(id)).hset(cacheKey(id), mapping=mapping).expire(cacheKey(id), timedelta(seconds=settings.redis_ttl)).execute()
+            if is_cache:
+                if redis.get("l1"):
+                    redis["l1"].set(cacheKey(id), entry, settings.redis_ttl)
+                log.debug(f"Profile datum is set to Redis with ttl {settings.redis_ttl} seconds")
+            else:
+                log.debug(f"Profile datum is not set to Redis")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot set profile datum to Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## set many data, or record that they do not exist, in one round trip
+    async def setEntries(self, entries: dict[str, CacheEntry], delta: float = 0.0):
+        if not entries:
+            return
+        try:
+            cached = {}
+            async with redis["client"].pipeline(transaction=False) as pipe:
+                for id, entry in entries.items():
+                    if entry.missing:
+                        ttl, mapping = settings.cache_negative_ttl, {"missing": 1}
+                    else:
+                        ttl, mapping = settings.redis_ttl, {"body": entry.body, "version": entry.version, **encodedMapping(entry.variants)}
+                        entry = entry._replace(ttl=ttl)
+                        if settings.cache_swr_enabled:
+                            entry = entry._replace(soft=time.time() + settings.redis_soft_ttl, delta=delta)
+                            mapping.update({"soft": entry.soft, "delta": delta})
+                    pipe.delete(cacheKey(id)).hset(cacheKey(id), mapping=mapping).expire(cacheKey(id), timedelta(seconds=ttl))
+                    cached[id] = (entry, ttl)
+                await pipe.execute()
+            if redis.get("l1"):
+                for id, (entry, ttl) in cached.items():
+                    redis["l1"].set(cacheKey(id), entry, ttl)
+            log.debug(f"{len(entries)} profile data are set to Redis")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot set profile data to Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## replace a datum after a write, dropping the copies other workers hold in their L1 cache
+    async def replaceEntry(self, id: str, body: bytes, version: str, variants: dict[str, bytes] | None = None):
+        try:
+            entry = CacheEntry(body, version, settings.redis_ttl, variants=variants)
+            mapping = {"body": body, "version": version, **encodedMapping(variants)}
+            if settings.cache_swr_enabled:
+                entry = entry._replace(soft=time.time() + settings.redis_soft_ttl)
+                mapping.update({"soft": entry.soft, "delta": 0.0})
+            ### replace the whole entry, fieldsets included, and notify other workers in one round trip
+            async with redis["client"].pipeline(transaction=True) as pipe:
+                pipe.delete(cacheKey(id)).hset(cacheKey(id), mapping=mapping).expire(cacheKey(id), timedelta(seconds=settings.redis_ttl))
+                if redis.get("l1"):
+                    pipe.publish(settings.l1_cache_channel, cacheKey(id))
+                await pipe.execute()
+            if redis.get("l1"):
+                redis["l1"].set(cacheKey(id), entry, settings.redis_ttl)
+            log.debug(f"Profile datum is replaced in Redis with ttl {settings.redis_ttl} seconds")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot replace profile datum in Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## record that a datum does not exist, for a short ttl
+    async def setMissing(self, id: str):
+        try:
+            async with redis["client"].pipeline(transaction=True) as pipe:
+                await pipe.delete(cacheKey(id)).hset(cacheKey(id), "missing", 1).expire(cacheKey(id), timedelta(seconds=settings.cache_negative_ttl)).execute()
+            if redis.get("l1"):
+                redis["l1"].set(cacheKey(id), CacheEntry(missing=True), settings.cache_negative_ttl)
+            log.debug(f"Missing profile datum is set to Redis with ttl {settings.cache_negative_ttl} seconds")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot set missing profile datum to Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## delete datum from redis, leaving a marker that sends the next fills to the primary for the read-your-writes window
+    async def deleteEntry(self, id: str):
+        try:
+            ### delete datum from redis and get number of deleted keys
+            async with redis["client"].pipeline(transaction=True) as pipe:
+                pipe.delete(cacheKey(id))
+                if settings.read_your_writes_window > 0:
+                    pipe.hset(cacheKey(id), "written", 1).expire(cacheKey(id), timedelta(seconds=settings.read_your_writes_window))
+                num, *_ = await pipe.execute()
+            ### invalidate L1 cache of this and every other worker
+            if redis.get("l1"):
+                redis["l1"].delete(cacheKey(id))
+                await redis["client"].publish(settings.l1_cache_channel, cacheKey(id))
+            if num >= 1:
+                log.debug(f"Profile datum is deleted from Redis")
+            else:
+                log.debug(f"Profile datum is not deleted from Redis")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot delete profile datum from Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## delete many data from redis in one round trip
+    async def deleteEntries(self, ids: list[str]):
+        if not ids:
+            return
+        try:
+            keys = [cacheKey(id) for id in ids]
+            async with redis["client"].pipeline(transaction=False) as pipe:
+                pipe.delete(*keys)
+                if settings.read_your_writes_window > 0:
+                    for key in keys:
+                        pipe.hset(key, "written", 1).expire(key, timedelta(seconds=settings.read_your_writes_window))
+                ### invalidate L1 cache of this and every other worker
+                if redis.get("l1"):
+                    for key in keys:
+                        redis["l1"].delete(key)
+                        pipe.publish(settings.l1_cache_channel, key)
+                num, *_ = await pipe.execute()
+            log.debug(f"{num} profile data are deleted from Redis")
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot delete profile data from Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## acquire the lock guarding a cache fill, returns None if another replica holds it
+    async def lock(self, id: str):
+        try:
+            lock = redis["client"].lock(f"lock:{cacheKey(id)}", timeout=settings.cache_lock_ttl / 1000)
+            if await lock.acquire(blocking=False):
+                return lock
+            return None
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "error": "Cannot lock profile datum in Redis",
+                    "reason": str(e)
+                }
+            )
+
+    ## release the lock guarding a cache fill
+    async def unlock(self, lock):
+        try:
+            await lock.release()
+        except Exception as e:
+            ### the lock expired and may be held by another replica already
+            log.debug(f"Profile cache lock is not released: {e}")
@@ -0,0 +1,27 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/singleflight.py
+
+import asyncio, contextvars
+
+class SingleFlight:
+    # Collapse concurrent calls for the same key into a single in-flight call
+    def __init__(self):
+        self._calls = {}
+
+    ## Run fn for key, or wait for the call already in flight; returns (result, shared)
+    async def do(self, key: str, fn):
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            ### run as a task so a cancelled caller does not cancel the waiters, in a context of its own so it does not
+            ### inherit the deadline (nor the driver timeouts) of the first caller, each waiter bounding its own wait
+            task = asyncio.create_task(fn(), context=contextvars.Context())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        ### mark the error as retrieved, every waiter may have given up on the call (e.g. past its deadline)
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,54 @@
+# Path: ols_svc_sample/app/internal/infrastructure/cache/store.py
+
+from abc import ABC, abstractmethod
+from fastapi import HTTPException
+from .entry import CacheEntry
+
+class CacheStore(ABC):
+    # Storage of serialized profiles used by the caching repository
+    @abstractmethod
+    ## get the entry of the fieldset, or else of the whole profile
+    async def getEntry(self, id: str, fields: tuple[str, ...] | None = None) -> CacheEntry:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    ## get the entries of many whole profiles, keyed by id
+    async def getEntries(self, ids: list[str]) -> dict[str, CacheEntry]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def getVersion(self, id: str) -> tuple[str | None, int]:
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def setEntry(self, id: str, body: bytes, version: str, delta: float = 0.0, fields: tuple[str, ...] | None = None, variants: dict[str, bytes] | None = None):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    ## set the entries of many whole profiles, missing ones included
+    async def setEntries(self, entries: dict[str, CacheEntry], delta: float = 0.0):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def replaceEntry(self, id: str, body: bytes, version: str, variants: dict[str, bytes] | None = None):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def setMissing(self, id: str):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def deleteEntry(self, id: str):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def deleteEntries(self, ids: list[str]):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def lock(self, id: str):
+        raise HTTPException(status_code=501, detail="Not Implemented")
+
+    @abstractmethod
+    async def unlock(self, lock):
+        raise HTTPException(status_code=501, detail="Not Implemented")
@@ -0,0 +1,21 @@
+# Path: ols_svc_sample/app/internal/infrastructure/consistency.py
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Set for the requests of a client that wrote within the read-your-writes window,
+# and for the reads filling the cache after a write, so they see the latest writes
+recent_write: ContextVar[bool] = ContextVar("recent_write", default=False)
+
+# Whether a read must see the latest writes: configured so, or following a write
+def read_latest(configured: bool = False) -> bool:
+    return configured or recent_write.get()
+
+# Route the reads of the block to the primary (strongly consistent reads on DynamoDB)
+@contextmanager
+def latest_reads(enabled: bool = True):
+    token = recent_write.set(recent_write.get() or enabled)
+    try:
+        yield
+    finally:
+        recent_write.reset(token)
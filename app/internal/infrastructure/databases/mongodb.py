@@ -1,16 +1,116 @@
 # Path: ols_svc_sample/app/infrastructure/databases/mongodb.py
 
 from motor import motor_asyncio
+from pymongo import monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 from ....internal.config import get_settings
+from ..indexes import Index
+from ..logger import log
+
+# Indexes of the profile collection: lookups by uuid, isConflict by email, conditional writes on updatedAt
+PROFILE_INDEXES = [
+    Index("uuid_1", (("uuid", 1),), unique=True),
+    Index("email_1", (("email", 1),), unique=True),
+    Index("updatedAt_1", (("updatedAt", 1),)),
+]
+
+# Read preference of a mode, with a staleness bound for the modes reading from secondaries
+def read_preference(mode: str, max_staleness: int = -1):
+    if mode == "primary":
+        return Primary()
+    modes = {"primaryPreferred": PrimaryPreferred, "secondary": Secondary, "secondaryPreferred": SecondaryPreferred, "nearest": Nearest}
+    return modes[mode](max_staleness=max_staleness)
+
+# Secondaries lag up to the staleness bound, the data written within the read-your-writes window are read from the primary;
+# the window must cover the bound, else a cache fill could store a datum older than the last write
+def check_read_your_writes(window: int, max_staleness: int, *modes: str):
+    if all(mode == "primary" for mode in modes):
+        return
+    if max_staleness < 0 or window < max_staleness:
+        raise ValueError(f"read_your_writes_window ({window}s) must cover mongo_max_staleness ({max_staleness}s) when reading from secondaries")
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    # Connection pool utilization, from the connection monitoring events of the driver
+    def __init__(self):
+        self.open = 0
+        self.in_use = 0
+        self.wait_timeouts = 0
+
+    def snapshot(self) -> dict:
+        return {"open": self.open, "in_use": self.in_use, "wait_timeouts": self.wait_timeouts}
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.in_use += 1
+
+    def connection_checked_in(self, event):
+        self.in_use -= 1
+
+    def connection_check_out_failed(self, event):
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            self.wait_timeouts += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
 
 class Mongo:
+    # One client, and so one connection pool, per process; created by the lifespan
     def __init__(self):
         self.settings = get_settings()
         ## Set mongo connection string
         self.uri = f"mongodb://{self.settings.mongo_user}:{self.settings.mongo_pass}@{self.settings.mongo_host}:{self.settings.mongo_port}/{self.settings.mongo_dbname}?authSource={self.settings.mongo_auth_source}&authMechanism={self.settings.mongo_auth_mechanism}&directConnection={self.settings.mongo_direct_connection}"
-        self._client = motor_asyncio.AsyncIOMotorClient(self.uri)
+        self.stats = PoolStats()
+        self._client = motor_asyncio.AsyncIOMotorClient(
+            self.uri,
+            maxPoolSize=self.settings.db_pool_size,
+            minPoolSize=self.settings.db_pool_min,
+            maxIdleTimeMS=self.settings.db_pool_idle_timeout * 1000,
+            waitQueueTimeoutMS=int(self.settings.db_pool_timeout * 1000),
+            connectTimeoutMS=int(self.settings.db_connect_timeout * 1000),
+            event_listeners=[self.stats],
+        )
+
+    ## Open connections ahead of the first requests
+    async def ping(self):
+        await self._client.admin.command("ping")
+
+    def close(self):
+        self._client.close()
 
     def getCollection(self):
         ## Get database
         collection = self._client[self.settings.mongo_dbname][self.settings.mongo_collection]
-        return collection
\ No newline at end of file
+        return collection
+
+# Whether the unique email index exists, else emails are checked by the repository before each write
+async def unique_email(collection) -> bool:
+    current = (await collection.index_information()).get("email_1")
+    return bool(current and current.get("unique") and tuple(tuple(key) for key in current["key"]) == (("email", 1),))
+
+# Create the declared indexes that are missing, returning the ones that differ or cannot be created
+async def ensure_indexes(collection, indexes: list[Index]) -> list[str]:
+    existing = await collection.index_information()
+    problems = []
+    for index in indexes:
+        current = existing.get(index.name)
+        if current is None:
+            try:
+                await collection.create_index(list(index.keys), name=index.name, unique=index.unique)
+                log.info(f"Mongo index {index.name} is created")
+            except Exception as e:
+                problems.append(f"cannot create {index.name}: {e}")
+        elif tuple(tuple(key) for key in current["key"]) != index.keys or current.get("unique", False) != index.unique:
+            problems.append(f"{index.name} is {current['key']} (unique={current.get('unique', False)}) instead of {list(index.keys)} (unique={index.unique})")
+    ## undeclared indexes only slow writes down, they are reported but kept
+    for name in existing.keys() - {index.name for index in indexes} - {"_id_"}:
+        log.warning(f"Mongo index {name} is not declared")
+    return problems
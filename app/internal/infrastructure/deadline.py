@@ -0,0 +1,66 @@
+# Path: ols_svc_sample/app/internal/infrastructure/deadline.py
+
+import asyncio, functools, inspect, time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from fastapi import HTTPException, status
+from .metrics import metrics
+
+# Monotonic time by which the current request must be answered, None for no deadline
+deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+# Context managers taking the seconds left, entered around every backend call to pass
+# the deadline down to the driver itself (e.g. pymongo.timeout, sent to mongo as maxTimeMS)
+deadline_scopes = []
+
+# Seconds left before the deadline of the current request, None without deadline
+def remaining() -> float | None:
+    at = deadline.get()
+    return None if at is None else at - time.monotonic()
+
+def exceeded(operation: str) -> HTTPException:
+    metrics.incr(f"deadline_exceeded:{operation}")
+    return HTTPException(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        detail={"msg": "Deadline exceeded", "reason": operation}
+    )
+
+# Run a backend call within the time left to the request, cancelling it once the deadline passes
+async def within(operation: str, call):
+    left = remaining()
+    if left is None:
+        return await call
+    if left <= 0:
+        call.close()
+        raise exceeded(operation)
+    try:
+        with ExitStack() as stack:
+            for scope in deadline_scopes:
+                stack.enter_context(scope(left))
+            return await asyncio.wait_for(call, left)
+    except TimeoutError:
+        raise exceeded(operation)
+    except HTTPException as e:
+        ### the driver gave up on its own timeout, derived from the same deadline
+        if e.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR and remaining() <= 0:
+            raise exceeded(operation)
+        raise
+
+class Bounded:
+    # Proxy running the coroutine methods of a backend within the deadline of the request,
+    # other attributes are passed through
+    def __init__(self, target, name: str):
+        self._target = target
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        method = getattr(self._target, attr)
+        if not inspect.iscoroutinefunction(method):
+            return method
+
+        @functools.wraps(method)
+        async def bounded(*args, **kwargs):
+            return await within(f"{self._name}.{attr}", method(*args, **kwargs))
+        ### resolved once, later lookups do not go through __getattr__
+        setattr(self, attr, bounded)
+        return bounded
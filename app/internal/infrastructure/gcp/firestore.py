@@ -1,13 +1,74 @@
 # Path: ols_svc_sample/app/internal/infrastructure/gcp/firestore.py
 
+import hashlib
 import google.cloud.firestore as firestore
-from ....dependencies import get_settings
+from google.cloud.firestore_admin_v1.services.firestore_admin import FirestoreAdminAsyncClient
+from google.cloud.firestore_admin_v1.types import Index as FirestoreIndex
+from ....internal.config import get_settings
+from ..indexes import Index
 
 settings = get_settings()
 
+# Indexes of the profile collection: the queries (pages and exports ordered by uuid, with or without a field
+# projection, which needs no index of its own, and isConflict by email) use automatic single-field indexes,
+# declared so that an override exempting them is reported; email guards are read by document id, without index
+PROFILE_INDEXES = [
+    Index("uuid_asc", (("uuid", "ASCENDING"),)),
+    Index("email_asc", (("email", "ASCENDING"),)),
+]
+
+# Id of the email guard document of an email, hashed as emails may hold characters ids cannot
+def guard_id(email: str) -> str:
+    return hashlib.sha256(email.encode()).hexdigest()
+
 class Firestore:
     def __init__(self):
         self.client = firestore.AsyncClient(database=settings.firestore_database, project=settings.firestore_project_id)
 
     def getCollection(self):
-        return self.client.collection(settings.firestore_collection)
\ No newline at end of file
+        return self.client.collection(settings.firestore_collection)
+
+    ## Open the grpc channel, which multiplexes every request, ahead of the first requests
+    async def ping(self):
+        await self.getCollection().document("warmup").get(field_paths=["uuid"])
+
+# Check the email guard collection holds the guards of a sample of the profiles; an empty collection does not exist
+# in Firestore, the guards of a sample are read instead
+async def check_email_guards(client, collection, emails, sample: int = 25) -> list[str]:
+    snapshots = [snapshot async for snapshot in collection.select(["uuid", "email"]).limit(sample).stream()]
+    guards = {snapshot.id async for snapshot in client.get_all([emails.document(guard_id(snapshot.get("email"))) for snapshot in snapshots], field_paths=["uuid"]) if snapshot.exists} if snapshots else set()
+    missing = [snapshot.get("uuid") for snapshot in snapshots if guard_id(snapshot.get("email")) not in guards]
+    return [f"{len(missing)} of {len(snapshots)} sampled profiles have no email guard document in {emails.id}, e.g. {missing[0]}"] if missing else []
+
+# Check the declared single-field indexes are not exempted and the declared composite indexes exist and are ready
+async def check_indexes(indexes: list[Index]) -> list[str]:
+    if not indexes:
+        return []
+    parent = f"projects/{settings.firestore_project_id}/databases/{settings.firestore_database}/collectionGroups/{settings.firestore_collection}"
+    client = FirestoreAdminAsyncClient()
+    problems = []
+    ## single-field indexes are automatic, only an override of the field without the declared order removes them
+    overrides = {}
+    async for field in await client.list_fields(request={"parent": parent, "filter": "indexConfig.usesAncestorConfig:false"}):
+        overrides[field.name.rsplit("/", 1)[-1]] = field
+    for index in indexes:
+        if len(index.keys) != 1:
+            continue
+        (path, order), = index.keys
+        field = overrides.get(path)
+        if field and not any(FirestoreIndex.IndexField.Order(key.order).name == order for current in field.index_config.indexes for key in current.fields):
+            problems.append(f"single-field index {index.name} is exempted by an override of {path}")
+    existing = {}
+    async for current in await client.list_indexes(parent=parent):
+        ### the implicit __name__ ordering is not part of the declaration
+        keys = tuple((field.field_path, FirestoreIndex.IndexField.Order(field.order).name) for field in current.fields if field.field_path != "__name__")
+        existing[keys] = current
+    for index in indexes:
+        if len(index.keys) == 1:
+            continue
+        current = existing.get(index.keys)
+        if current is None:
+            problems.append(f"composite index {index.name} on {list(index.keys)} is missing")
+        elif current.state != FirestoreIndex.State.READY:
+            problems.append(f"composite index {index.name} is {FirestoreIndex.State(current.state).name}")
+    return problems
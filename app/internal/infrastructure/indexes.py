@@ -0,0 +1,30 @@
+# Path: ols_svc_sample/app/internal/infrastructure/indexes.py
+
+from typing import NamedTuple
+from .logger import log
+from ...internal.config import get_settings
+
+settings = get_settings()
+
+class Index(NamedTuple):
+    # An index a backend needs: its name, its (field, order) keys, the order
+    # being backend specific (1/-1, HASH/RANGE, ASCENDING/DESCENDING), and whether it is unique
+    name: str
+    keys: tuple[tuple[str, int | str], ...]
+    unique: bool = False
+
+# Stop the startup when the email guards are missing or were not backfilled, whatever index_policy:
+# emails would not be kept unique
+def require_email_guards(backend: str, problems: list[str]):
+    if problems:
+        raise RuntimeError(f"{backend} emails are not kept unique: {'; '.join(problems)}; run python -m scripts.backfill_email_guards")
+
+# Report the differences between the declared and the existing indexes, per index_policy
+def report_drift(backend: str, problems: list[str]):
+    if not problems:
+        log.info(f"{backend} indexes are up to date")
+        return
+    for problem in problems:
+        log.warning(f"{backend} index drift: {problem}")
+    if settings.index_policy == "fail":
+        raise RuntimeError(f"{backend} indexes do not match the declared ones: {'; '.join(problems)}")
@@ -1,7 +1,88 @@
 # Path: ols_svc_sample/app/internal/infrastructure/logger.py
 
-import uvicorn, logging
+import atexit, logging, queue, sys, threading, orjson, uvicorn
+from datetime import datetime, timezone
 from fastapi.logger import logger
+from .metrics import metrics
+from ..config import get_settings
+
+settings = get_settings()
+
+## JSON lines carrying the fields indexed by logstash at the top level, so no parsing is needed there
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        line.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            line["stack_trace"] = self.formatException(record.exc_info)
+        return orjson.dumps(line, default=str).decode()
+
+## Uvicorn default format, the structured fields being printed as the message
+class TextFormatter(uvicorn.logging.DefaultFormatter):
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.message = orjson.dumps(fields, default=str).decode()
+        return super().formatMessage(record)
+
+class QueueHandler(logging.Handler):
+    # Hands the records to a background writer through a bounded queue, the event loop never blocks on stdout;
+    # records are dropped and counted when the writer cannot keep up
+    def __init__(self, size: int = 10000, batch: int = 256):
+        super().__init__()
+        self.queue = queue.Queue(size)
+        self.batch = batch
+        self.stream = sys.stdout.buffer
+        self.writer = threading.Thread(target=self.write, name="log-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("log_dropped")
+
+    ## Write the queued records in batches, one write and one flush per batch
+    def write(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            ### None is queued on close, once every record before it is written
+            stop = None in records
+            lines = []
+            for record in records:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.format(record).encode() + b"\n")
+                except Exception:
+                    self.handleError(record)
+            try:
+                self.stream.write(b"".join(lines))
+                self.stream.flush()
+            except Exception:
+                metrics.incr("log_dropped", len(lines))
+            if stop:
+                return
+
+    ## Flush the pending records, waiting at most a second for the writer
+    def close(self):
+        if self.writer.is_alive():
+            try:
+                self.queue.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+            self.writer.join(timeout=1.0)
+        super().close()
 
 class Logger:
     def __init__(self):
@@ -10,17 +91,19 @@ class Logger:
     def getLogger(self):
         ## set fastapi log level
         self.log.setLevel(logging.DEBUG)
-        ## set stream handler
-        ch = logging.StreamHandler()
+        if self.log.hasHandlers():
+            return self.log
+        ## set queue handler, written to stdout by a background thread
+        ch = QueueHandler(settings.log_queue_size, settings.log_batch_size)
         ch.setLevel(logging.DEBUG)
-        ## set log format
-        formatter = logging.Formatter('%(levelprefix)s %(asctime)s %(message)s')
-        FORMAT: str = "%(levelprefix)s %(asctime)s | %(message)s"
-        ## set Uvicorn default log format
-        formatter = uvicorn.logging.DefaultFormatter(FORMAT)
+        ## set log format, json lines are shipped as is, text keeps the uvicorn default format
+        if settings.log_format == "json":
+            formatter = JsonFormatter()
+        else:
+            FORMAT: str = "%(levelprefix)s %(asctime)s | %(message)s"
+            formatter = TextFormatter(FORMAT)
         ch.setFormatter(formatter)
-        if not self.log.hasHandlers():
-            self.log.addHandler(ch)
+        self.log.addHandler(ch)
         return self.log
 
-log = Logger().getLogger()
\ No newline at end of file
+log = Logger().getLogger()
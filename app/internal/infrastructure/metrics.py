@@ -0,0 +1,21 @@
+# Path: ols_svc_sample/app/internal/infrastructure/metrics.py
+
+from collections import Counter
+
+class Metrics:
+    # In-process counters, exposed on GET /v1/metrics
+    def __init__(self):
+        self.counters = Counter()
+        self.gauges = {}
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    ## Register a gauge, read when the snapshot is taken
+    def register(self, name: str, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self) -> dict:
+        return {"counters": dict(self.counters), "gauges": {name: fn() for name, fn in self.gauges.items()}}
+
+metrics = Metrics()
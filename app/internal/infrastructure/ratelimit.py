@@ -0,0 +1,156 @@
+# Path: ols_svc_sample/app/internal/infrastructure/ratelimit.py
+
+import asyncio, math, time
+from .logger import log
+from .metrics import metrics
+from ..config import get_settings
+
+settings = get_settings()
+
+# Global bucket of a key, refilled with the redis clock and charged with the tokens a worker took since its last sync;
+# returns the tokens left to every worker
+SYNC_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local taken = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.max(0, math.min(capacity, tokens + math.max(0, now - updated) * rate) - taken)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return tostring(tokens)
+"""
+
+# Limits of a comma separated setting, as {name: (times, seconds)}, e.g. "postBatch=5/60,export=1/60"
+def parse_limits(limits: str) -> dict[str, tuple[int, int]]:
+    parsed = {}
+    for item in limits.split(","):
+        name, _, limit = item.strip().rpartition("=")
+        if not name:
+            continue
+        times, _, seconds = limit.partition("/")
+        parsed[name.strip()] = (int(times), int(seconds))
+    return parsed
+
+class TokenBucket:
+    # Up to `capacity` tokens, refilled at `rate` tokens per second; a request takes one token,
+    # the tokens taken and not yet reported to redis are counted
+    __slots__ = ("capacity", "rate", "tokens", "updated", "unreported", "touched", "synced")
+
+    def __init__(self, capacity: int, rate: float, now: float, tokens: float | None = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity if tokens is None else tokens)
+        self.updated = now
+        self.unreported = 0
+        self.touched = False
+        self.synced = False
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        self.touched = True
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.unreported += 1
+        return True
+
+    ## Seconds until the next token
+    def wait(self) -> float:
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    # Token buckets kept in process, so admitting a request costs no round trip, and reconciled with redis
+    # every `rate_limit_sync_interval`, or earlier once a bucket took its share of tokens (`rate_limit_tolerance`)
+    # without reporting them; a worker limits on its own while redis is not available
+    def __init__(self):
+        self.buckets = {}
+        self.client = None
+        self.script = None
+        self.distributed = False
+        self.wake = asyncio.Event()
+        metrics.register("rate_limit", self.snapshot)
+
+    def snapshot(self) -> dict:
+        return {"mode": "distributed" if self.distributed else "local", "buckets": len(self.buckets)}
+
+    ## Take a token of the bucket of a key; returns 0 if the request is admitted, else the seconds to wait
+    def acquire(self, key: str, times: int, seconds: int) -> float:
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            ### other workers may have used the global bucket already, only the tolerated share is taken before the first sync
+            bucket = self.buckets[key] = TokenBucket(times, times / seconds, now, max(1.0, times * settings.rate_limit_tolerance) if self.distributed else None)
+        if not bucket.take(now):
+            metrics.incr("rate_limited")
+            ### the bucket gets its share of the global tokens at the next sync
+            if self.distributed and not bucket.synced:
+                return min(bucket.wait(), settings.rate_limit_sync_interval / 1000)
+            return bucket.wait()
+        ### sync early rather than let each worker drift further from the global bucket
+        if self.client and bucket.unreported >= max(1.0, times * settings.rate_limit_tolerance):
+            self.wake.set()
+        return 0.0
+
+    ## Reconcile the buckets with redis until cancelled, client being None to limit locally only
+    async def run(self, client=None):
+        self.client = client
+        self.script = client.register_script(SYNC_SCRIPT) if client else None
+        self.wake = asyncio.Event()
+        self.distributed = client is not None
+        while True:
+            ### asyncio.wait, unlike wait_for, never swallows the cancellation of the loop when woken at the same time
+            waiter = asyncio.create_task(self.wake.wait())
+            try:
+                await asyncio.wait((waiter,), timeout=settings.rate_limit_sync_interval / 1000)
+            finally:
+                waiter.cancel()
+            self.wake.clear()
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.incr("rate_limit_sync_errors")
+                if self.distributed:
+                    log.warning(f"Rate limiter cannot sync with Redis, limiting locally: {e!r}")
+                self.distributed = False
+
+    ## Report the tokens taken by the buckets since the last sync and take the tokens left globally,
+    ## for the buckets used or still refilling, as other workers may be draining them
+    async def sync(self):
+        now = time.monotonic()
+        touched = []
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.touched or bucket.tokens < bucket.capacity:
+                touched.append((key, bucket, bucket.unreported))
+                bucket.touched, bucket.unreported = False, 0
+            else:
+                ### idle buckets that filled up again hold nothing worth keeping
+                del self.buckets[key]
+        if not self.client or not touched:
+            return
+        ### the reported tokens are not retried if the sync fails, the buckets keep limiting locally
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, bucket, taken in touched:
+                await self.script(keys=[f"ratelimit:{key}"], args=[bucket.capacity, bucket.rate, taken, math.ceil(bucket.capacity / bucket.rate * 1000)], client=pipe)
+            results = await asyncio.wait_for(pipe.execute(), settings.rate_limit_sync_timeout / 1000)
+        now = time.monotonic()
+        for (key, bucket, taken), tokens in zip(touched, results):
+            ### the tokens taken while the sync was in flight are not reported yet
+            bucket.refill(now)
+            bucket.tokens = max(0.0, float(tokens) - bucket.unreported)
+            bucket.synced = True
+        if not self.distributed:
+            log.info("Rate limiter is synced with Redis again")
+        self.distributed = True
+
+limiter = RateLimiter()
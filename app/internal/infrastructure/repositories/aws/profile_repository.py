@@ -1,13 +1,46 @@
 # Path: ols_svc_sample/app/internal/infrastructure/repositories/aws/profile_repository.py
 
+from __future__ import annotations
 # from datetime import timedelta
+import asyncio, json, math, random
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError
 from fastapi import HTTPException, status
 from graphql import GraphQLError
-from ....domain.interfaces.profile_interface import ProfileInterface
+from ....domain.interfaces.profile_interface import ProfileInterface, batch_status
 from ....domain.models.profile import Profile, ProfileCreate, ProfileUpdate
 from ...logger import log
 from ....adapter.event_handler import dynamodb
+from ...consistency import read_latest
+from .....internal.config import get_settings
+
+settings = get_settings()
+
+# Raise why a conditional write failed, from the item returned with the failure:
+# the datum does not exist, or it is no longer at the given version
+def notMatched(error: ClientError):
+    if "Item" in error.response:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Profile has been modified")
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+
+# Item in the low level format of the transaction API
+serializer = TypeSerializer()
+def marshal(item: dict) -> dict:
+    return {key: serializer.serialize(value) for key, value in item.items()}
+
+deserializer = TypeDeserializer()
+def unmarshal(item: dict) -> dict:
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
+
+# ProjectionExpression of a sparse fieldset, names are aliased as some are reserved words
+def projection(fields: tuple[str, ...] | None = None) -> dict:
+    if not fields:
+        return {}
+    return {
+        "ProjectionExpression": ", ".join(f"#{name}" for name in fields),
+        "ExpressionAttributeNames": {f"#{name}": name for name in fields},
+    }
 
 class ProfileRepository(ProfileInterface):
     def __init__(self, transport: str = "http"):
@@ -45,11 +78,13 @@ class ProfileRepository(ProfileInterface):
                 },
             )
 
-    async def list(self, offset: int = 0, limit: int = 10) -> list:
+    async def list(self, offset: int = 0, limit: int = 10, fields: tuple[str, ...] | None = None) -> list:
         try:
             response = await dynamodb["table"].scan(
+                ConsistentRead=read_latest(settings.dynamodb_consistent_scan),
                 Limit=limit,
-                ExclusiveStartKey={'uuid': str(offset)}
+                ExclusiveStartKey={'uuid': str(offset)},
+                **projection(fields)
             )
             return response.get('Items', [])
         except Boto3Error as e:
@@ -69,10 +104,73 @@ class ProfileRepository(ProfileInterface):
                     }
                 )
 
-    async def get(self, id: str) -> Profile:
+    async def listAfter(self, after: str | None = None, limit: int = 10, fields: tuple[str, ...] | None = None) -> tuple[list, str | None]:
+        try:
+            # Resume the scan from the table key of the last item returned
+            start = {"ExclusiveStartKey": {'uuid': after}} if after else {}
+            response = await dynamodb["table"].scan(Limit=limit, ConsistentRead=read_latest(settings.dynamodb_consistent_scan), **start, **projection(fields))
+            last = response.get('LastEvaluatedKey')
+            return response.get('Items', []), last['uuid'] if last else None
+        except Boto3Error as e:
+            if self.transport == "http":
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail = {
+                        "msg": "Cannot list profile data",
+                        "reason": str(e)
+                    }
+                )
+            elif self.transport == "graphql":
+                raise GraphQLError(
+                    message = "Cannot list profile data",
+                    extensions = {
+                        "reason": str(e)
+                    }
+                )
+
+    async def export(self, checkpoint: str | None = None):
+        # Parallel scan, the checkpoint records where each segment stopped ("done" once exhausted)
+        state = json.loads(checkpoint) if checkpoint else {"segments": settings.export_segments, "keys": {}}
+        total, keys = state["segments"], state["keys"]
+        # Bounded, so segments stop scanning while the client is not reading
+        queue = asyncio.Queue(maxsize=total)
+        consistent = read_latest(settings.dynamodb_consistent_scan)
+
+        async def scan(segment: int, start: dict | None):
+            try:
+                while True:
+                    resume = {"ExclusiveStartKey": start} if start else {}
+                    response = await dynamodb["table"].scan(Segment=segment, TotalSegments=total, Limit=settings.export_batch_size, ConsistentRead=consistent, **resume)
+                    start = response.get('LastEvaluatedKey')
+                    await queue.put((segment, response.get('Items', []), start))
+                    if not start:
+                        return
+            except Exception as e:
+                await queue.put(e)
+
+        tasks = [asyncio.create_task(scan(segment, keys.get(str(segment)))) for segment in range(total) if keys.get(str(segment)) != "done"]
+        try:
+            running = len(tasks)
+            while running:
+                item = await queue.get()
+                if isinstance(item, Exception):
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail={"msg": "Cannot export profile data", "reason": str(item)}
+                    )
+                segment, items, start = item
+                keys[str(segment)] = start or "done"
+                if not start:
+                    running -= 1
+                yield items, json.dumps(state)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get(self, id: str, fields: tuple[str, ...] | None = None) -> Profile:
         try:
-            response = await dynamodb["table"].get_item(Key={'uuid':id})
-            return response
+            response = await dynamodb["table"].get_item(Key={'uuid':id}, ConsistentRead=read_latest(settings.dynamodb_consistent_get), **projection(fields))
+            return response.get('Item')
         except Boto3Error as e:
             ### Raise exception the transport is http
             if self.transport == "http":
@@ -92,25 +190,82 @@ class ProfileRepository(ProfileInterface):
                     }
                 )
 
-    async def create(self, datum: ProfileCreate) -> ProfileCreate:
+    # Get data by id with BatchGetItem, keyed by id
+    async def getMany(self, ids: list[str], fields: tuple[str, ...] | None = None) -> dict[str, dict]:
         try:
-            response = await dynamodb["table"].put_item(Item=datum.model_dump())
-            log.debug("Create Response: %s", response)
-            if response["ResponseMetadata"]["HTTPStatusCode"] < 500:
-                return datum
+            return {item["uuid"]: item for item in await self.batchGet(ids, fields, read_latest(settings.dynamodb_consistent_scan))}
+        except (Boto3Error, ClientError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"msg": "Cannot get profile data", "reason": str(e)}
+            )
+
+    async def getVersion(self, id: str) -> str | None:
+        try:
+            response = await dynamodb["table"].get_item(
+                Key={'uuid': id},
+                ProjectionExpression="updatedAt",
+            )
         except Boto3Error as e:
             raise HTTPException(
-                status_code=response["ResponseMetadata"]["HTTPStatusCode"],
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"msg": "Cannot get profile datum version", "reason": str(e)}
+            )
+        if "Item" not in response:
+            return None
+        return str(response["Item"].get("updatedAt"))
+
+    ## Get the email of a datum, which keys its email guard item
+    async def getEmail(self, id: str) -> str | None:
+        response = await dynamodb["table"].get_item(Key={'uuid': id}, ConsistentRead=True, **projection(("email",)))
+        return response.get('Item', {}).get("email")
+
+    ## Write items in one transaction, a failed condition raising the (status, detail) of its item
+    async def transact(self, items: list[dict], failures: list[tuple[int, str]]):
+        try:
+            await dynamodb["resource"].meta.client.transact_write_items(TransactItems=items)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "TransactionCanceledException":
+                for reason, (code, detail) in zip(e.response.get("CancellationReasons", []), failures):
+                    if reason.get("Code") == "ConditionalCheckFailed":
+                        raise HTTPException(status_code=code, detail=detail)
+            raise
+
+    async def create(self, datum: ProfileCreate) -> ProfileCreate:
+        try:
+            # The email guard item makes emails unique, the profile and its guard are written together or not at all
+            await self.transact([
+                {"Put": {
+                    "TableName": settings.dynamodb_table,
+                    "Item": marshal(datum.model_dump()),
+                    "ConditionExpression": "attribute_not_exists(#uuid)",
+                    "ExpressionAttributeNames": {"#uuid": "uuid"},
+                }},
+                {"Put": {
+                    "TableName": settings.dynamodb_email_table,
+                    "Item": marshal({"email": datum.email, "uuid": datum.uuid}),
+                    "ConditionExpression": "attribute_not_exists(email)",
+                }},
+            ], [
+                (status.HTTP_409_CONFLICT, "Profile already exist"),
+                (status.HTTP_409_CONFLICT, "Profile email already exist"),
+            ])
+            return datum
+        except (Boto3Error, ClientError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail={"msg": "Cannot create profile datum", "reason": str(e)}
             )
 
-    async def update(self, id: str, datum: ProfileUpdate):
+    # Update a datum, returning the updated datum
+    async def update(self, id: str, datum: ProfileUpdate, version: str | None = None) -> dict:
         try:
             update_expression = "SET "
             expression_attribute_values = {}
             expression_attribute_names = {}
 
-            for key, value in datum.model_dump().items():
+            ### the key is not updatable, batch items carry it
+            for key, value in datum.model_dump(exclude={"uuid"}).items():
                 if value is not None:  # Skip null or None value
                     update_expression += f"#{key} = :{key}, "
                     expression_attribute_values[f":{key}"] = value
@@ -118,25 +273,181 @@ class ProfileRepository(ProfileInterface):
 
             update_expression = update_expression.rstrip(", ")  # Remove trailing comma
 
+            # Only update an existing item, update_item would create it otherwise
+            conditions = ["attribute_exists(#uuid)"]
+            expression_attribute_names["#uuid"] = "uuid"
+            if version:  # Only update if the item is still at the given version
+                conditions.append("updatedAt = :current_version")
+                expression_attribute_values[":current_version"] = version
+
+            # A new email moves the email guard item, in the same transaction as the update
+            email = await self.getEmail(id) if datum.email else None
+            if email and email != datum.email:
+                conditions.append("email = :current_email")
+                expression_attribute_values[":current_email"] = email
+                await self.transact([
+                    {"Update": {
+                        "TableName": settings.dynamodb_table,
+                        "Key": marshal({'uuid': id}),
+                        "UpdateExpression": update_expression,
+                        "ExpressionAttributeNames": expression_attribute_names,
+                        "ExpressionAttributeValues": marshal(expression_attribute_values),
+                        "ConditionExpression": " AND ".join(conditions),
+                    }},
+                    {"Put": {
+                        "TableName": settings.dynamodb_email_table,
+                        "Item": marshal({"email": datum.email, "uuid": id}),
+                        "ConditionExpression": "attribute_not_exists(email)",
+                    }},
+                    {"Delete": {
+                        "TableName": settings.dynamodb_email_table,
+                        "Key": marshal({"email": email}),
+                    }},
+                ], [
+                    (status.HTTP_412_PRECONDITION_FAILED, "Profile has been modified"),
+                    (status.HTTP_409_CONFLICT, "Profile email already exist"),
+                ])
+                ## transactions do not return items
+                response = await dynamodb["table"].get_item(Key={'uuid': id}, ConsistentRead=True)
+                return response.get('Item')
+
             update  = await dynamodb["table"].update_item(
                 Key={'uuid': id},
                 UpdateExpression=update_expression,
                 ExpressionAttributeNames=expression_attribute_names,
-                ExpressionAttributeValues=expression_attribute_values
+                ExpressionAttributeValues=expression_attribute_values,
+                ConditionExpression=" AND ".join(conditions),
+                ReturnValues="ALL_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
             )
             # log.debug("Update: %s", update)
-            return update
+            return update["Attributes"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                notMatched(e)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"msg": "Cannot update profile datum", "reason": str(e)}
+            )
         except Boto3Error as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail={"msg": "Cannot update profile datum", "reason": str(e)}
             )
 
-    async def delete(self, id: str):
+    async def delete(self, id: str, version: str | None = None):
         try:
-            await dynamodb["table"].delete_item(Key={'uuid': id})
-        except Boto3Error as e:
+            # The email guard item is keyed by email, read consistently so it is deleted along with the profile
+            email = await self.getEmail(id)
+            for attempt in range(3):
+                if not email:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+                conditions, values = ["email = :current_email"], {":current_email": email}
+                if version:  # Only delete if the item is still at the given version
+                    conditions.append("updatedAt = :current_version")
+                    values[":current_version"] = version
+                try:
+                    await dynamodb["resource"].meta.client.transact_write_items(TransactItems=[
+                        {"Delete": {
+                            "TableName": settings.dynamodb_table,
+                            "Key": marshal({'uuid': id}),
+                            "ConditionExpression": " AND ".join(conditions),
+                            "ExpressionAttributeValues": marshal(values),
+                            "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+                        }},
+                        {"Delete": {
+                            "TableName": settings.dynamodb_email_table,
+                            "Key": marshal({"email": email}),
+                        }},
+                    ])
+                    return
+                except ClientError as e:
+                    reasons = e.response.get("CancellationReasons") or [{}]
+                    if e.response["Error"]["Code"] != "TransactionCanceledException" or reasons[0].get("Code") != "ConditionalCheckFailed":
+                        raise
+                    ### the profile was deleted, modified (412 only against an If-Match) or its email changed meanwhile,
+                    ### the item returned with the failure tells which, a new email is deleted on the next attempt
+                    current = unmarshal(reasons[0]["Item"]) if reasons[0].get("Item") else None
+                    if current and version and current.get("updatedAt") != version:
+                        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Profile has been modified")
+                    email = current and current.get("email")
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Profile is being modified concurrently"
+            )
+        except (Boto3Error, ClientError) as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail={"msg": "Cannot delete profile datum", "reason": str(e)}
-            )
\ No newline at end of file
+            )
+
+    # Batch
+    ## Get data by id with BatchGetItem (100 keys per call), from the profile table or from another table and key
+    async def batchGet(self, ids: list[str], fields: tuple[str, ...] | None = None, consistent: bool = False, table: str | None = None, key: str = "uuid") -> list[dict]:
+        table = table or settings.dynamodb_table
+        items = []
+        keys = [{key: id} for id in dict.fromkeys(ids)]
+        for start in range(0, len(keys), 100):
+            request = {table: {"Keys": keys[start:start + 100], "ConsistentRead": consistent, **projection(fields)}}
+            for attempt in range(settings.dynamodb_batch_retries + 1):
+                response = await dynamodb["resource"].batch_get_item(RequestItems=request)
+                items.extend(response["Responses"].get(table, []))
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+                ### throttled keys are returned unprocessed, retry them with capped exponential backoff and full jitter
+                if attempt < settings.dynamodb_batch_retries:
+                    await asyncio.sleep(random.uniform(0, min(settings.dynamodb_batch_backoff_max, settings.dynamodb_batch_backoff * 2 ** attempt)) / 1000)
+            else:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail={"msg": "Cannot get profile data", "reason": f"{len(request[table]['Keys'])} keys are still throttled after {settings.dynamodb_batch_retries} retries"},
+                    headers={"Retry-After": str(math.ceil(settings.dynamodb_batch_backoff_max / 1000))},
+                )
+        return items
+
+    ## Get which of the ids exist
+    async def existing(self, ids: list[str]) -> set[str]:
+        try:
+            return {item["uuid"] for item in await self.batchGet(ids, ("uuid",))}
+        except (Boto3Error, ClientError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"msg": "Cannot check if profile data exist", "reason": str(e)}
+            )
+
+    ## Get which of the emails are already used, reading their email guard items consistently
+    async def conflicts(self, emails: list[str]) -> set[str]:
+        try:
+            return {item["email"] for item in await self.batchGet(emails, ("email",), True, settings.dynamodb_email_table, "email")}
+        except (Boto3Error, ClientError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"msg": "Cannot check profile data integrity", "reason": str(e)}
+            )
+
+    ## Create data concurrently, returning the status of each datum; BatchWriteItem cannot put conditionally,
+    ## each datum and its email guard item are written in a transaction failing if the email is used meanwhile (409)
+    async def createMany(self, data: list[ProfileCreate]) -> list[int]:
+        results = await asyncio.gather(*(self.create(datum) for datum in data), return_exceptions=True)
+        return [batch_status(result, status.HTTP_201_CREATED) for result in results]
+
+    ## Update data concurrently, BatchWriteItem only puts or deletes whole items; returns the status of each datum
+    async def updateMany(self, data: list[tuple[str, ProfileUpdate]]) -> list[int]:
+        results = await asyncio.gather(*(self.update(id, datum) for id, datum in data), return_exceptions=True)
+        return [batch_status(result) for result in results]
+
+    ## Delete data and their email guard items with BatchWriteItem
+    async def deleteMany(self, ids: list[str]):
+        try:
+            items = await self.batchGet(ids, ("uuid", "email"))
+            async with dynamodb["table"].batch_writer() as batch, dynamodb["emails"].batch_writer() as guards:
+                for item in items:
+                    await batch.delete_item(Key={'uuid': item["uuid"]})
+                    if item.get("email"):
+                        await guards.delete_item(Key={'email': item["email"]})
+        except (Boto3Error, ClientError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"msg": "Cannot delete profile data", "reason": str(e)}
+            )
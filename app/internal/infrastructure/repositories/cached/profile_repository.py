@@ -0,0 +1,246 @@
+# Path: ols_svc_sample/app/internal/infrastructure/repositories/cached/profile_repository.py
+
+from __future__ import annotations
+import asyncio, time, orjson
+from decimal import Decimal
+from datetime import date
+from ....domain.interfaces.profile_interface import ProfileInterface
+from ....domain.models.profile import Profile, ProfileCreate, ProfileUpdate, narrow_profile
+from ...cache.entry import CacheEntry
+from ...cache.store import CacheStore
+from ...cache.singleflight import SingleFlight
+from ...cache.batcher import Batcher
+from ...cache.encoding import compress
+from ...consistency import latest_reads, read_latest
+from ...deadline import Bounded, deadline, within
+from ...metrics import metrics
+from ...logger import log
+from .....internal.config import get_settings
+
+settings = get_settings()
+
+# Serialize types returned by the datastores that orjson does not handle natively
+def default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError
+
+# Serialize a datum, validated against the profile narrowed to the fieldset if any
+def serialize(datum: dict, fields: tuple[str, ...] | None = None) -> bytes:
+    if fields:
+        return narrow_profile(fields).model_validate(datum).model_dump_json().encode()
+    return orjson.dumps(datum, default=default)
+
+class CachedProfileRepository(ProfileInterface):
+    # Read-through, invalidate-on-write cache in front of any profile repository,
+    # every call to the datastore and the cache being bounded by the deadline of the request
+    def __init__(self, repository: ProfileInterface, store: CacheStore):
+        self.repository = Bounded(repository, "datastore")
+        self.store = Bounded(store, "cache")
+        self.singleflight = SingleFlight()
+        self.revalidating = {}
+        ## misses of whole profiles arriving together are read from the datastore in one query,
+        ## shared by requests with different deadlines, so each of them only bounds its own wait
+        self.reads = Batcher("datastore_read", repository.getMany, settings.read_batch_window / 1000, settings.read_batch_size) if settings.read_batch_enabled else None
+
+    # Delegated to the datastore
+    async def isExist(self, id: str) -> bool:
+        return await self.repository.isExist(id)
+
+    async def isConflict(self, datum: ProfileCreate) -> bool:
+        return await self.repository.isConflict(datum)
+
+    async def list(self, skip: int = 0, limit: int = 10, fields: tuple[str, ...] | None = None) -> list:
+        return await self.repository.list(skip, limit, fields)
+
+    async def listAfter(self, after: str | None = None, limit: int = 10, fields: tuple[str, ...] | None = None) -> tuple[list, str | None]:
+        return await self.repository.listAfter(after, limit, fields)
+
+    def export(self, checkpoint: str | None = None):
+        return self.repository.export(checkpoint)
+
+    async def create(self, datum: ProfileCreate) -> ProfileCreate:
+        datum = await self.repository.create(datum)
+        ### clear a negative entry recorded for this id
+        await self.store.deleteEntry(datum.uuid)
+        return datum
+
+    # Read-through
+    ## Get the serialized datum, or only the given fields, from cache or from the datastore; returns (entry, hit)
+    async def getEntry(self, id: str, fields: tuple[str, ...] | None = None) -> tuple[CacheEntry | None, bool]:
+        entry = await self.store.getEntry(id, fields)
+        ### the datum is known not to exist
+        if entry.missing:
+            metrics.incr("cache_negative_hit")
+            return None, True
+        if entry.body:
+            metrics.incr("cache_hit")
+            ### past the soft expiry (or early, XFetch), serve the cached datum and refresh it in background
+            if entry.shouldRefresh(settings.cache_xfetch_beta):
+                self.revalidate(id)
+            ### the whole profile is cached, narrow it to the fieldset without a datastore read
+            if entry.fields != fields:
+                entry = entry._replace(body=serialize(orjson.loads(entry.body), fields), fields=fields, variants=None)
+            return entry, True
+        ### get the datum from the datastore, once per id and fieldset across concurrent requests;
+        ### the fill runs in a context of its own, reads that must see the latest writes are passed along and not
+        ### coalesced with fills that may read a secondary
+        key = f"{id}?fields={','.join(fields)}" if fields else id
+        latest = entry.written or read_latest()
+        if latest:
+            key = f"{key}&latest"
+        entry, shared = await within("datastore.fill", self.singleflight.do(key, lambda: self.fill(id, fields, latest)))
+        metrics.incr("cache_coalesced" if shared else "cache_miss")
+        return entry, False
+
+    ## Get the serialized data, or only the given fields, of many ids in one cache round trip and one datastore query
+    ## for the ids missed by the cache; returns the entries keyed by id, None for the data that do not exist
+    async def getEntries(self, ids: list[str], fields: tuple[str, ...] | None = None) -> dict[str, CacheEntry | None]:
+        cached = await self.store.getEntries(ids)
+        entries, misses = {}, []
+        for id in dict.fromkeys(ids):
+            entry = cached.get(id) or CacheEntry()
+            if entry.missing:
+                metrics.incr("cache_negative_hit")
+                entries[id] = None
+            elif entry.body:
+                metrics.incr("cache_hit")
+                if entry.shouldRefresh(settings.cache_xfetch_beta):
+                    self.revalidate(id)
+                entries[id] = entry
+            else:
+                misses.append(id)
+        if misses:
+            metrics.incr("cache_miss", len(misses))
+            start = time.monotonic()
+            ### data written within the read-your-writes window are read from the primary
+            with latest_reads(any(cached[id].written for id in misses if id in cached)):
+                data = await self.repository.getMany(misses)
+            ### backfill the cache, remembering the data that do not exist
+            fills = {id: self.toEntry(data[id]) if id in data else CacheEntry(missing=True) for id in misses}
+            await self.store.setEntries(fills, time.monotonic() - start)
+            entries.update({id: None if entry.missing else entry for id, entry in fills.items()})
+        ### the whole profiles are cached, narrow them to the fieldset in process
+        if fields:
+            entries = {id: entry and entry._replace(body=serialize(orjson.loads(entry.body), fields), fields=fields, variants=None) for id, entry in entries.items()}
+        return entries
+
+    ## Get a datum
+    async def get(self, id: str, fields: tuple[str, ...] | None = None) -> Profile:
+        entry, _ = await self.getEntry(id, fields)
+        return orjson.loads(entry.body) if entry else None
+
+    ## Get data from the datastore, keyed by id
+    async def getMany(self, ids: list[str], fields: tuple[str, ...] | None = None) -> dict:
+        return await self.repository.getMany(ids, fields)
+
+    ## Get the version of a datum, from cache or from the datastore
+    async def getVersion(self, id: str) -> str | None:
+        version, _ = await self.store.getVersion(id)
+        return version or await self.repository.getVersion(id)
+
+    ## Get only the cached version and its remaining ttl
+    async def getCacheVersion(self, id: str) -> tuple[str | None, int]:
+        return await self.store.getVersion(id)
+
+    ## Get a datum from the datastore, serialize it once and cache it, the result is shared by coalesced requests;
+    ## a datum written within the read-your-writes window is read from the primary
+    async def fill(self, id: str, fields: tuple[str, ...] | None = None, latest: bool = False) -> CacheEntry | None:
+        lock = None
+        ### fieldsets are cheap projected reads, only fills of the whole profile are locked
+        if settings.cache_lock_enabled and not fields:
+            lock = await self.store.lock(id)
+            if not lock:
+                ### another replica is filling the cache, wait for it before falling back to the datastore
+                deadline = asyncio.get_running_loop().time() + settings.cache_lock_wait / 1000
+                while asyncio.get_running_loop().time() < deadline:
+                    await asyncio.sleep(0.05)
+                    entry = await self.store.getEntry(id)
+                    if entry.missing:
+                        return None
+                    if entry.body:
+                        return entry
+        try:
+            start = time.monotonic()
+            ### the version is read along with the fieldset
+            with latest_reads(latest):
+                if fields:
+                    datum = await self.repository.get(id, tuple(sorted({*fields, "updatedAt"})))
+                ### only reads that may be served by a secondary are batched, the batch runs in a context of its own
+                elif self.reads and not read_latest():
+                    datum = await within("datastore.getMany", self.reads.load(id))
+                else:
+                    datum = await self.repository.get(id)
+            if not datum:
+                ### remember the datum does not exist, so repeated lookups skip the datastore
+                await self.store.setMissing(id)
+                return None
+            ### cache datum with its version and the time it took to fetch
+            entry = self.toEntry(datum, fields)
+            await self.store.setEntry(id, entry.body, entry.version, time.monotonic() - start, fields, entry.variants)
+            return entry
+        finally:
+            if lock:
+                await self.store.unlock(lock)
+
+    ## Serialize a datum once, compressing the whole profile once too, the variants being served as is
+    def toEntry(self, datum: dict, fields: tuple[str, ...] | None = None) -> CacheEntry:
+        body = serialize(datum, fields)
+        return CacheEntry(body, str(datum.get("updatedAt")), fields=fields, variants=None if fields else compress(body))
+
+    ## Refresh a cached datum in background, once per id until the refresh lands, sharing the in-flight fill if any
+    def revalidate(self, id: str):
+        if id in self.revalidating:
+            return
+        metrics.incr("cache_revalidate")
+        async def refresh():
+            ### the refresh outlives the request, it is not bound by its deadline
+            deadline.set(None)
+            try:
+                await self.singleflight.do(id, lambda: self.fill(id))
+            except Exception as e:
+                log.warning(f"Cannot revalidate cached profile {id}: {e}")
+        ### keep a reference so the task is not garbage collected while running
+        self.revalidating[id] = asyncio.create_task(refresh())
+        self.revalidating[id].add_done_callback(lambda _: self.revalidating.pop(id, None))
+
+    # Write-through on update, invalidate on delete
+    async def update(self, id: str, datum: ProfileUpdate, version: str | None = None) -> dict:
+        datum = await self.repository.update(id, datum, version)
+        ### cache the updated datum, so the next read is a hit
+        entry = self.toEntry(datum)
+        await self.store.replaceEntry(id, entry.body, entry.version, entry.variants)
+        return datum
+
+    async def delete(self, id: str, version: str | None = None):
+        await self.repository.delete(id, version)
+        await self.store.deleteEntry(id)
+
+    # Batch, invalidating the cache of every datum in one round trip
+    async def existing(self, ids: list[str]) -> set[str]:
+        return await self.repository.existing(ids)
+
+    async def conflicts(self, emails: list[str]) -> set[str]:
+        return await self.repository.conflicts(emails)
+
+    ### a batch failing part way may have written some of its data, every datum sent is invalidated,
+    ### which for created data clears the negative entries recorded for their ids
+    async def createMany(self, data: list[ProfileCreate]) -> list[int]:
+        try:
+            return await self.repository.createMany(data)
+        finally:
+            await self.store.deleteEntries([datum.uuid for datum in data])
+
+    async def updateMany(self, data: list[tuple[str, ProfileUpdate]]) -> list[int]:
+        try:
+            return await self.repository.updateMany(data)
+        finally:
+            await self.store.deleteEntries([id for id, _ in data])
+
+    async def deleteMany(self, ids: list[str]):
+        try:
+            await self.repository.deleteMany(ids)
+        finally:
+            await self.store.deleteEntries(ids)
@@ -1,13 +1,18 @@
 # Path: ols_svc_sample/app/internal/infrastructure/repositories/gcp/profile_repository.py
 
+from __future__ import annotations
 # from datetime import timedelta
+import asyncio
 from fastapi import HTTPException, status
+from google.api_core.exceptions import Conflict, NotFound
+from google.cloud.firestore import async_transactional
 from graphql import GraphQLError
-from ....domain.interfaces.profile_interface import ProfileInterface
+from ....domain.interfaces.profile_interface import ProfileInterface, batch_status
 from ....domain.models.profile import Profile, ProfileCreate, ProfileUpdate
 from ...logger import log
 from .....internal.config import get_settings
-from ....infrastructure.gcp.firestore import Firestore
+from ....adapter.event_handler import firestore
+from ...gcp.firestore import guard_id
 
 settings = get_settings()
 
@@ -16,16 +21,27 @@ class ProfileRepository(ProfileInterface):
     def __init__(self, transport: str = "http"):
         ## Transport
         self.transport = transport
-        ## Initialize mongo and redis
-        self.collection = Firestore().getCollection()
+
+    ## Client shared by the process and its collections, available once the lifespan started
+    @property
+    def client(self):
+        return firestore["client"]
+
+    @property
+    def collection(self):
+        return firestore["collection"]
+
+    @property
+    def emails(self):
+        return firestore["emails"]
     # MongoDb
     ## Check the existence of data
     async def isExist(self, id: str) -> bool:
         try:
             ### Get datum from mongodb
-            datum = await self.collection.document(id).get()
-            ### Check if datum exists in mongodb
-            if datum:
+            datum = await self.collection.document(id).get(field_paths=["uuid"])
+            ### Check if datum exists in firestore
+            if datum.exists:
                 return True
             else:
                 return False
@@ -58,24 +74,13 @@ class ProfileRepository(ProfileInterface):
             )
 
     ## List data with pagination
-    async def list(self, order_by: str = "uuid", limit: int = 1, offset: int = 10) -> list[Profile]:
+    async def list(self, skip: int = 0, limit: int = 10, fields: tuple[str, ...] | None = None) -> list[Profile]:
         ## List Data
         try:
-            ## ref: https://cloud.google.com/firestore/docs/samples/firestore-query-cursor-pagination-async
-            first_query = self.collection.order_by(order_by).limit(limit)
-            # Get the last document from the results
-            docs = [d async for d in first_query.stream()]
-            last_doc = list(docs)[-1]
-            # Construct a new query starting at this document
-            # Note: this will not have the desired effect if
-            # multiple profile have the exact same profile value
-            last_pop = last_doc.to_dict()[order_by]
-
-            next_query = (
-                self.collection.order_by(order_by).start_at({order_by: last_pop}).limit(offset)
-            )
-            new_docs = [d async for d in next_query.stream()]
-            data = [Profile(**d.to_dict()) for d in new_docs]
+            query = self.collection.order_by("uuid").offset(skip).limit(limit)
+            if fields:
+                query = query.select(list(fields))
+            data = [Profile(**d.to_dict()) async for d in query.stream()]
         except Exception as e:
             if self.transport == "http":
                 raise HTTPException(
@@ -94,11 +99,64 @@ class ProfileRepository(ProfileInterface):
                 )
         return data
     
+    ## List data after a key, using a query cursor on uuid so every page costs the same
+    async def listAfter(self, after: str | None = None, limit: int = 10, fields: tuple[str, ...] | None = None) -> tuple[list, str | None]:
+        try:
+            ## ref: https://cloud.google.com/firestore/docs/samples/firestore-query-cursor-pagination-async
+            query = self.collection.order_by("uuid")
+            if fields:
+                query = query.select(list(fields))
+            if after:
+                query = query.start_after({"uuid": after})
+            data = [Profile(**d.to_dict()) async for d in query.limit(limit).stream()]
+        except Exception as e:
+            if self.transport == "http":
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail = {
+                        "msg": "Cannot list profile data",
+                        "reason": str(e)
+                    }
+                )
+            elif self.transport == "graphql":
+                raise GraphQLError(
+                    message = "Cannot list profile data",
+                    extensions = {
+                        "reason": str(e)
+                    }
+                )
+        ### a full page may be followed by another one
+        return data, data[-1].uuid if len(data) == limit else None
+
+    ## Stream every datum in batches ordered by uuid, each batch with the uuid to resume after
+    async def export(self, checkpoint: str | None = None):
+        query = self.collection.order_by("uuid")
+        if checkpoint:
+            query = query.start_after({"uuid": checkpoint})
+        try:
+            batch = []
+            async for doc in query.stream():
+                batch.append(doc.to_dict())
+                if len(batch) == settings.export_batch_size:
+                    yield batch, batch[-1]["uuid"]
+                    batch = []
+            if batch:
+                yield batch, batch[-1]["uuid"]
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot export profile data",
+                    "reason": str(e)
+                }
+            )
+
     ## Get datum by id
-    async def get(self, id: str) -> Profile:
+    async def get(self, id: str, fields: tuple[str, ...] | None = None) -> Profile:
         try:
-            ### Retrieve a datum
-            datum = await self.collection.document(id).get()
+            ### Retrieve a datum, or only the given fields
+            snapshot = await self.collection.document(id).get(field_paths=list(fields) if fields else None)
+            datum = snapshot.to_dict() if snapshot.exists else None
         except Exception as e:
             ### Raise exception the transport is http
             if self.transport == "http":
@@ -118,13 +176,68 @@ class ProfileRepository(ProfileInterface):
                     }
                 )
         return datum
+
+    ## Get data by id in one round trip, keyed by id
+    async def getMany(self, ids: list[str], fields: tuple[str, ...] | None = None) -> dict[str, dict]:
+        try:
+            references = [self.collection.document(id) for id in dict.fromkeys(ids)]
+            return {snapshot.id: snapshot.to_dict() async for snapshot in self.client.get_all(references, field_paths=list(fields) if fields else None) if snapshot.exists}
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot get profile data",
+                    "reason": str(e)
+                }
+            )
+
+    ## Get the version (updatedAt) of a datum without fetching its body
+    async def getVersion(self, id: str) -> str | None:
+        try:
+            ### Retrieve only the version field
+            datum = await self.collection.document(id).get(field_paths=["updatedAt"])
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot get profile datum version",
+                    "reason": str(e)
+                }
+            )
+        if not datum.exists:
+            return None
+        return str(datum.get("updatedAt"))
+
+    ## Email guard document of an email, hashed as emails may hold characters not allowed in document ids
+    def emailGuard(self, email: str):
+        return self.emails.document(guard_id(email))
+
+    ## Apply a write in a transaction, only if the datum exists (404) and is still at the given version (412);
+    ## the write gets the current datum, to maintain the email guard, and its result is returned
+    async def writeIfVersion(self, id: str, version: str | None, write, field_paths: list[str] | None = None):
+        reference = self.collection.document(id)
+
+        @async_transactional
+        async def transaction_write(transaction):
+            snapshot = await reference.get(field_paths=field_paths, transaction=transaction)
+            if not snapshot.exists:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+            if version and str(snapshot.get("updatedAt")) != version:
+                raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Profile has been modified")
+            return write(transaction, reference, snapshot.to_dict())
+
+        return await transaction_write(self.client.transaction())
     
-    ## Create datum
+    ## Create datum along with its email guard, in one atomic batch failing if either exists
     async def create(self, datum: ProfileCreate)-> ProfileCreate:
         try:
-            ## create datum in mongodb
-            await self.collection.document(datum.uuid).set(datum.model_dump())
+            batch = self.client.batch()
+            batch.create(self.emailGuard(datum.email), {"email": datum.email, "uuid": datum.uuid})
+            batch.create(self.collection.document(datum.uuid), datum.model_dump())
+            await batch.commit()
             return datum
+        except Conflict:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -134,11 +247,26 @@ class ProfileRepository(ProfileInterface):
                 }
             )
         
-    ## Update a datum
-    async def update(self, id: str, datum: ProfileUpdate):
+    ## Update a datum, only if it is still at the given version, returning the updated datum
+    async def update(self, id: str, datum: ProfileUpdate, version: str | None = None) -> dict:
+        changes = datum.model_dump(exclude_unset=True, exclude={"uuid"})
+
+        ### a new email moves the email guard, in the same transaction as the update
+        def write(transaction, reference, current):
+            if changes.get("email") and changes["email"] != current.get("email"):
+                transaction.create(self.emailGuard(changes["email"]), {"email": changes["email"], "uuid": id})
+                if current.get("email"):
+                    transaction.delete(self.emailGuard(current["email"]))
+            transaction.update(reference, changes)
+            return {**current, **changes}
+
         try:
-            # Update the rest of the fields
-            await self.collection.document(id).update(datum.model_dump(exclude_unset=True))
+            # The datum is read and updated in one transaction, returning the updated datum without another read
+            return await self.writeIfVersion(id, version, write)
+        except HTTPException:
+            raise
+        except Conflict:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -148,11 +276,18 @@ class ProfileRepository(ProfileInterface):
                 }
             )
         
-    ## Delete a datum
-    async def delete(self, id: str):
+    ## Delete a datum and its email guard, only if it is still at the given version
+    async def delete(self, id: str, version: str | None = None):
+        def write(transaction, reference, current):
+            transaction.delete(reference)
+            if current.get("email"):
+                transaction.delete(self.emailGuard(current["email"]))
+
         try:
-            ### delete datum from mongodb
-            await self.collection.document(id).delete()
+            ### delete datum from firestore
+            await self.writeIfVersion(id, version, write, ["updatedAt", "email"])
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -160,4 +295,90 @@ class ProfileRepository(ProfileInterface):
                     "msg": "Cannot delete profile datum",
                     "reason": str(e)
                 }
-            )
\ No newline at end of file
+            )
+
+    # Batch
+    ## Get which of the ids exist, in one round trip
+    async def existing(self, ids: list[str]) -> set[str]:
+        try:
+            references = [self.collection.document(id) for id in dict.fromkeys(ids)]
+            return {snapshot.id async for snapshot in self.client.get_all(references, field_paths=["uuid"]) if snapshot.exists}
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot check if profile data exist",
+                    "reason": str(e)
+                }
+            )
+
+    ## Get which of the emails are already used, reading their email guards in one round trip
+    async def conflicts(self, emails: list[str]) -> set[str]:
+        try:
+            references = [self.emailGuard(email) for email in dict.fromkeys(emails)]
+            return {snapshot.get("email") async for snapshot in self.client.get_all(references, field_paths=["email"]) if snapshot.exists}
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot check profile data integrity",
+                    "reason": str(e)
+                }
+            )
+
+    ## Apply writes in batches of 500 writes, the most a batched write holds
+    async def writeMany(self, items: list, write, msg: str, writes: int = 1):
+        try:
+            size = 500 // writes
+            for start in range(0, len(items), size):
+                batch = self.client.batch()
+                for item in items[start:start + size]:
+                    write(batch, item)
+                await batch.commit()
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": msg,
+                    "reason": str(e)
+                }
+            )
+
+    ## Create data concurrently, returning the status of each datum; a batched write fails as a whole,
+    ## so each datum is created with its email guard in a batch of its own, failing if the email is used meanwhile (409)
+    async def createMany(self, data: list[ProfileCreate]) -> list[int]:
+        results = await asyncio.gather(*(self.create(datum) for datum in data), return_exceptions=True)
+        return [batch_status(result, status.HTTP_201_CREATED) for result in results]
+
+    ## Update data concurrently, returning the status of each datum; a batched write fails as a whole,
+    ## so each datum is updated on its own, new emails going through a transaction moving their email guard
+    async def updateMany(self, data: list[tuple[str, ProfileUpdate]]) -> list[int]:
+        async def updateOne(id: str, datum: ProfileUpdate):
+            if datum.email:
+                return await self.update(id, datum)
+            try:
+                await self.collection.document(id).update(datum.model_dump(exclude_unset=True, exclude={"uuid"}))
+            except NotFound:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+        results = await asyncio.gather(*(updateOne(id, datum) for id, datum in data), return_exceptions=True)
+        return [batch_status(result) for result in results]
+
+    ## Delete data and their email guards with batched writes
+    async def deleteMany(self, ids: list[str]):
+        try:
+            references = [self.collection.document(id) for id in dict.fromkeys(ids)]
+            snapshots = [snapshot async for snapshot in self.client.get_all(references, field_paths=["email"]) if snapshot.exists]
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot delete profile data",
+                    "reason": str(e)
+                }
+            )
+        def write(batch, snapshot):
+            batch.delete(snapshot.reference)
+            email = (snapshot.to_dict() or {}).get("email")
+            if email:
+                batch.delete(self.emailGuard(email))
+        await self.writeMany(snapshots, write, "Cannot delete profile data", 2)
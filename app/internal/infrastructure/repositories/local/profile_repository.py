@@ -1,21 +1,38 @@
 # app/internal/infrastructure/repositories/local/profile_repository.py
 
-from datetime import timedelta
+from __future__ import annotations
 from fastapi import HTTPException, status
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from graphql import GraphQLError
 from ....domain.interfaces.profile_interface import ProfileInterface
 from ....domain.models.profile import Profile, ProfileCreate, ProfileUpdate
-from ...databases.mongodb import Mongo
-from ....adapter.event_handler import redis
+from ....adapter.event_handler import mongo
+from ...consistency import read_latest
 from ...logger import log
+from .....internal.config import get_settings
+
+settings = get_settings()
+
+# Mongo projection of a sparse fieldset, the whole datum but its _id by default
+def projection(fields: tuple[str, ...] | None = None) -> dict:
+    return {"_id": 0, **{name: 1 for name in fields}} if fields else {"_id": 0}
 
 class ProfileRepository(ProfileInterface):
     # Profile Repository constructor
     def __init__(self, transport: str = "http"):
         ## Transport
         self.transport = transport
-        ## Get profile collection
-        self.collection = Mongo().getCollection()
+
+    ## Profile collection of the client shared by the process, available once the lifespan started
+    @property
+    def collection(self):
+        return mongo["collection"]
+
+    ## Collection to read from with the read preference of a kind of read ("scan" or "get"),
+    ## the primary for the reads that must see the latest writes
+    def reader(self, kind: str):
+        return mongo["collection"] if read_latest() else mongo[kind]
 
     # MongoDb
     ## Check the existence of data
@@ -56,10 +73,10 @@ class ProfileRepository(ProfileInterface):
             )
 
     ## List data with pagination
-    async def list(self, skip: int = 0, limit: int = 10) -> list[Profile]:
+    async def list(self, skip: int = 0, limit: int = 10, fields: tuple[str, ...] | None = None) -> list[Profile]:
         ## List Data
         try:
-            data = await self.collection.find().skip(skip).limit(limit).to_list(length=limit)
+            data = await self.reader("scan").find({}, projection(fields)).skip(skip).limit(limit).to_list(length=limit)
         except Exception as e:
             if self.transport == "http":
                 raise HTTPException(
@@ -81,11 +98,60 @@ class ProfileRepository(ProfileInterface):
             # datum["_id"] = str(datum["_id"])
         return data
 
+    ## List data after a key, using the unique uuid index so every page costs the same
+    async def listAfter(self, after: str | None = None, limit: int = 10, fields: tuple[str, ...] | None = None) -> tuple[list, str | None]:
+        try:
+            query = {"uuid": {"$gt": after}} if after else {}
+            data = await self.reader("scan").find(query, projection(fields)).sort("uuid", 1).limit(limit).to_list(length=limit)
+        except Exception as e:
+            if self.transport == "http":
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail = {
+                        "msg": "Cannot list profile data",
+                        "reason": str(e)
+                    }
+                )
+            elif self.transport == "graphql":
+                raise GraphQLError(
+                    message = "Cannot list profile data",
+                    extensions = {
+                        "reason": str(e)
+                    }
+                )
+        ### a full page may be followed by another one
+        return data, data[-1]["uuid"] if len(data) == limit else None
+
+    ## Stream every datum in batches ordered by uuid, each batch with the uuid to resume after
+    async def export(self, checkpoint: str | None = None):
+        query = {"uuid": {"$gt": checkpoint}} if checkpoint else {}
+        cursor = self.reader("scan").find(query, {"_id": 0}).sort("uuid", 1).batch_size(settings.export_batch_size)
+        try:
+            batch = []
+            async for datum in cursor:
+                batch.append(datum)
+                if len(batch) == settings.export_batch_size:
+                    yield batch, batch[-1]["uuid"]
+                    batch = []
+            if batch:
+                yield batch, batch[-1]["uuid"]
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot export profile data",
+                    "reason": str(e)
+                }
+            )
+        finally:
+            ### release the server cursor when the client goes away early
+            await cursor.close()
+
     ## Get datum by id
-    async def get(self, id: str) -> Profile:
+    async def get(self, id: str, fields: tuple[str, ...] | None = None) -> Profile:
         try:
-            ### Retrieve a datum
-            datum = await self.collection.find_one({"uuid": id})
+            ### Retrieve a datum, or only the given fields, without its mongodb _id
+            datum = await self.reader("get").find_one({"uuid": id}, projection(fields))
         except Exception as e:
             ### Raise exception the transport is http
             if self.transport == "http":
@@ -105,13 +171,48 @@ class ProfileRepository(ProfileInterface):
                     }
                 )
         return datum
+
+    ## Get data by id in one query, keyed by id
+    async def getMany(self, ids: list[str], fields: tuple[str, ...] | None = None) -> dict[str, dict]:
+        try:
+            data = await self.reader("scan").find({"uuid": {"$in": ids}}, projection(fields)).to_list(length=len(ids))
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot get profile data",
+                    "reason": str(e)
+                }
+            )
+        return {datum["uuid"]: datum for datum in data}
+
+    ## Get the version (updatedAt) of a datum without fetching its body
+    async def getVersion(self, id: str) -> str | None:
+        try:
+            ### project only the version field
+            datum = await self.collection.find_one({"uuid": id}, {"_id": 0, "updatedAt": 1})
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot get profile datum version",
+                    "reason": str(e)
+                }
+            )
+        if not datum:
+            return None
+        return str(datum.get("updatedAt"))
     
     ## Create datum
     async def create(self, datum: ProfileCreate)-> ProfileCreate:
+        if await self.emailsTaken([(datum.uuid, datum.email)]):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
         try:
-            ## create datum in mongodb
-            temp = await self.collection.insert_one(datum)
+            ## create datum in mongodb, the unique email index rejects a used email
+            temp = await self.collection.insert_one(datum.model_dump())
             return datum
+        except DuplicateKeyError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -121,10 +222,15 @@ class ProfileRepository(ProfileInterface):
                 }
             )
         
-    ## Update a datum
-    async def update(self, id: str, datum: ProfileUpdate):
+    ## Update a datum, only if it is still at the given version, returning the updated datum
+    async def update(self, id: str, datum: ProfileUpdate, version: str | None = None) -> dict:
+        if datum.email and await self.emailsTaken([(id, datum.email)]):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
         try:
-            await self.collection.update_one({"uuid": id}, {"$set": datum})
+            query = {"uuid": id, "updatedAt": version} if version else {"uuid": id}
+            result = await self.collection.find_one_and_update(query, {"$set": datum.model_dump(exclude_unset=True)}, projection(), return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile email already exist")
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -133,12 +239,42 @@ class ProfileRepository(ProfileInterface):
                     "reason": str(e)
                 }
             )
+        if result is None:
+            await self.notMatched(id, version)
+        return result
+
+    ## Get which of the (id, email) pairs take an email used by another datum; the unique email index rejects them
+    ## in the write itself, without it (not created, or not buildable over duplicates) they are checked before writing
+    async def emailsTaken(self, data: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        if mongo.get("unique_email") or not data:
+            return set()
+        try:
+            used = await self.collection.find({"email": {"$in": [email for _, email in data]}}, {"_id": 0, "uuid": 1, "email": 1}).to_list(length=None)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot check profile datum integrity",
+                    "reason": str(e)
+                }
+            )
+        owners = {}
+        for datum in used:
+            owners.setdefault(datum["email"], set()).add(datum["uuid"])
+        return {(id, email) for id, email in data if owners.get(email, set()) - {id}}
+
+    ## Raise why no datum matched a write: it does not exist, or it is no longer at the given version
+    async def notMatched(self, id: str, version: str | None = None):
+        if version and await self.isExist(id):
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Profile has been modified")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
         
-    ## Delete a datum
-    async def delete(self, id: str):
+    ## Delete a datum, only if it is still at the given version
+    async def delete(self, id: str, version: str | None = None):
         try:
             ### delete datum from mongodb
-            await self.collection.delete_one({"uuid": id})
+            query = {"uuid": id, "updatedAt": version} if version else {"uuid": id}
+            result = await self.collection.delete_one(query)
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -147,82 +283,108 @@ class ProfileRepository(ProfileInterface):
                     "reason": str(e)
                 }
             )
-        
-    # Redis
-    ### get datum from redis
-    async def getCache(self, id: str) -> str:
-        try:
-            ### get datum from redis
-            value = await redis["client"].get(f"profile:{id}")
-            if value:
-                log.debug(f"Profile datum is retrieved from Redis")
-            else:
-                log.debug(f"Profile datum is not retrieved from Redis")
-            return value
+        if result.deleted_count == 0:
+            await self.notMatched(id, version)
+
+    # Batch
+    ## Get which of the ids exist, in one query
+    async def existing(self, ids: list[str]) -> set[str]:
+        try:
+            data = await self.collection.find({"uuid": {"$in": ids}}, {"_id": 0, "uuid": 1}).to_list(length=len(ids))
         except Exception as e:
-            if self.transport == "http":
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail = {
-                        "msg": "Cannot get profile datum from Redis",
-                        "reason": str(e)
-                    }
-                )
-            elif self.transport == "graphql":
-                raise GraphQLError(
-                    message="Cannot get profile datum from Redis",
-                    extensions={
-                        "reason": str(e)
-                    }
-                )
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot check if profile data exist",
+                    "reason": str(e)
+                }
+            )
+        return {datum["uuid"] for datum in data}
 
-    ## set datum to redis with ttl
-    async def setCache(self, id: str, profile: Profile):
+    ## Get which of the emails are already used, in one query
+    async def conflicts(self, emails: list[str]) -> set[str]:
         try:
-            ### set profile data to redis with ttl
-            is_cache = await redis["client"].setex(f"profile:{id}", timedelta(seconds=redis['ttl']), profile)
-            if is_cache:
-                log.debug(f"Profile datum is set to Redis with ttl {redis['ttl']} seconds")
-            else:
-                log.debug(f"Profile datum is not set to Redis")
+            data = await self.collection.find({"email": {"$in": emails}}, {"_id": 0, "email": 1}).to_list(length=len(emails))
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail = {
-                    "error": "Cannot set profile datum to Redis",
+                    "msg": "Cannot check profile data integrity",
                     "reason": str(e)
                 }
             )
-        
-    ## delete datum from redis
-    async def deleteCache(self, id: str):
+        return {datum["email"] for datum in data}
+
+    ## Create data in one round trip, returning the status of each datum
+    async def createMany(self, data: list[ProfileCreate]) -> list[int]:
+        statuses = [status.HTTP_201_CREATED] * len(data)
+        if not data:
+            return statuses
         try:
-            ### delete datum from redis and get number of deleted keys
-            num = await redis["client"].delete(f"profile:{id}")
-            if num >= 1:
-                log.debug(f"Profile datum is deleted from Redis")
+            await self.collection.insert_many([datum.model_dump() for datum in data], ordered=False)
+        except BulkWriteError as e:
+            ### the unique email index rejects data created concurrently, the others are still inserted
+            for error in e.details["writeErrors"]:
+                statuses[error["index"]] = status.HTTP_409_CONFLICT if error["code"] == 11000 else status.HTTP_500_INTERNAL_SERVER_ERROR
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail = {
+                    "msg": "Cannot create profile data",
+                    "reason": str(e)
+                }
+            )
+        return statuses
+
+    ## Update data in one round trip, returning the status of each datum
+    async def updateMany(self, data: list[tuple[str, ProfileUpdate]]) -> list[int]:
+        statuses = [status.HTTP_200_OK] * len(data)
+        taken = await self.emailsTaken([(id, datum.email) for id, datum in data if datum.email])
+        accepted = []
+        for index, (id, datum) in enumerate(data):
+            if (id, datum.email) in taken:
+                statuses[index] = status.HTTP_409_CONFLICT
             else:
-                log.debug(f"Profile datum is not deleted from Redis")
+                accepted.append(index)
+        if not accepted:
+            return statuses
+        try:
+            try:
+                result = await self.collection.bulk_write([UpdateOne({"uuid": data[index][0]}, {"$set": data[index][1].model_dump(exclude_unset=True, exclude={"uuid"})}) for index in accepted], ordered=False)
+                matched = result.matched_count
+            except BulkWriteError as e:
+                ### the unique email index rejects the data taking a used email, the others are still updated
+                for error in e.details["writeErrors"]:
+                    statuses[accepted[error["index"]]] = status.HTTP_409_CONFLICT if error["code"] == 11000 else status.HTTP_500_INTERNAL_SERVER_ERROR
+                matched = e.details["nMatched"]
+            ### updates matching nothing were deleted since the batch was checked, the count tells whether to look for them
+            written = [index for index in accepted if statuses[index] == status.HTTP_200_OK]
+            if matched < len(written):
+                found = {datum["uuid"] for datum in await self.collection.find({"uuid": {"$in": [data[index][0] for index in written]}}, {"_id": 0, "uuid": 1}).to_list(length=None)}
+                for index in written:
+                    if data[index][0] not in found:
+                        statuses[index] = status.HTTP_404_NOT_FOUND
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail = {
-                    "error": "Cannot delete profile datum from Redis",
+                    "msg": "Cannot update profile data",
                     "reason": str(e)
                 }
             )
-        
-    ## get redis ttl
-    async def getTtl(self, id: str) -> int:
+        return statuses
+
+    ## Delete data in one round trip
+    async def deleteMany(self, ids: list[str]):
+        if not ids:
+            return
         try:
-            ### get redis ttl
-            ttl = await redis["client"].ttl(f"profile:{id}")
-            return ttl
+            await self.collection.delete_many({"uuid": {"$in": ids}})
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail = {
-                    "error": "Cannot get ttl from Redis",
+                    "msg": "Cannot delete profile data",
                     "reason": str(e)
                 }
-            )
\ No newline at end of file
+            )
@@ -0,0 +1,56 @@
+# Path: ols_svc_sample/benchmarks/cache_read.py
+# Compare the cache hit path of GET /v1/profiles/{uuid}:
+#   before: TTL, HMGET, TTL (three round trips)
+#   after:  MULTI HMGET TTL EXEC (one round trip)
+# Usage: python -m benchmarks.cache_read [iterations]
+
+import sys, time, asyncio, ujson
+from redis import asyncio as aioredis
+from app.internal.config import get_settings
+
+settings = get_settings()
+
+PROFILE = {
+    "uuid": "bench",
+    "email": "bench@example.com",
+    "firstname": "Bench",
+    "lastname": "Mark",
+    "addresses": [{"type": "home", "city": "Jakarta", "postalCode": 12345}],
+    "image": {"name": "bench.png", "url": "https://example.com/bench.png"},
+}
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+async def three_round_trips(client, key: str):
+    await client.ttl(key)
+    await client.hmget(key, "body", "version", "soft", "delta")
+    await client.ttl(key)
+
+async def one_round_trip(client, key: str):
+    async with client.pipeline(transaction=True) as pipe:
+        await pipe.hmget(key, "body", "version", "soft", "delta").ttl(key).execute()
+
+async def run(name: str, fn, client, key: str, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn(client, key)
+        samples.append((time.perf_counter() - start) * 1000)
+    print(f"{name:<20} p50={percentile(samples, 0.50):.3f}ms p99={percentile(samples, 0.99):.3f}ms")
+
+async def main(iterations: int):
+    uri = f"redis://:{settings.redis_pass}@{settings.redis_host}:{settings.redis_port}/{settings.redis_db}"
+    async with aioredis.from_url(uri, encoding="utf-8", decode_responses=True) as client:
+        key = "profile:v2:bench"
+        await client.hset(key, mapping={"body": ujson.dumps(PROFILE), "version": "2024-01-01T00:00:00"})
+        await client.expire(key, settings.redis_ttl)
+        ## warm up the connection pool
+        await run("warmup", one_round_trip, client, key, 100)
+        await run("ttl+hmget+ttl", three_round_trips, client, key, iterations)
+        await run("pipeline", one_round_trip, client, key, iterations)
+        await client.delete(key)
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
@@ -0,0 +1,78 @@
+# Path: ols_svc_sample/benchmarks/logging_middleware.py
+# Requests per second through the access log middleware, on an endpoint doing no work:
+#   before: BaseHTTPMiddleware, json.dumps of every request and response header
+#   after:  pure ASGI middleware, allow-listed headers, 2xx sampled at LOG_SAMPLE_RATE
+# Usage: python -m benchmarks.logging_middleware [requests]
+
+import sys, time, json, asyncio, logging
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from starlette.middleware.base import BaseHTTPMiddleware
+from app.internal.adapter.middleware import LoggingMiddleware
+from app.internal.infrastructure.logger import log
+
+# The middleware as it was, logging of 2xx/3xx/4xx only
+class BaseLoggingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        request.state.start_time = time.time()
+        response = await call_next(request)
+        process_time = (time.time() - request.state.start_time) * 1000
+        structured_log = {
+            "method": request.method,
+            "status_code": response.status_code,
+            "path": request.url.path,
+            "latency": f"{process_time:.2f}ms",
+            "request": {"headers": dict(request.headers)},
+            "response": {"headers": dict(response.headers)},
+        }
+        log.info(json.dumps(structured_log))
+        return response
+
+def make_app(middleware=None) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/v1/profiles/{uuid}")
+    async def get(uuid: str):
+        return Response(content=b'{"uuid":"bench"}', media_type="application/json", headers={"X-Cache": "HIT"})
+
+    if middleware:
+        app.add_middleware(middleware)
+    return app
+
+SCOPE = {
+    "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+    "path": "/v1/profiles/bench", "raw_path": b"/v1/profiles/bench", "root_path": "", "query_string": b"",
+    "server": ("testserver", 80), "client": ("127.0.0.1", 1234),
+    "headers": [(b"host", b"testserver"), (b"user-agent", b"bench"), (b"accept", b"*/*"), (b"accept-encoding", b"gzip"), (b"cookie", b"session=secret")],
+}
+
+# Receive of a request without body, whose client then stays connected
+def make_receive():
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+    return receive
+
+async def send(message):
+    pass
+
+async def run(name: str, app, requests: int):
+    ## warm up the routing and the middleware stack
+    for _ in range(100):
+        await app(dict(SCOPE), make_receive(), send)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(SCOPE), make_receive(), send)
+    print(f"{name:<20} {requests / (time.perf_counter() - start):,.0f} req/s")
+
+async def main(requests: int):
+    ## measure the middleware, not the terminal
+    log.handlers = [logging.NullHandler()]
+    await run("no middleware", make_app(), requests)
+    await run("BaseHTTPMiddleware", make_app(BaseLoggingMiddleware), requests)
+    await run("pure ASGI", make_app(LoggingMiddleware), requests)
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
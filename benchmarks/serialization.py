@@ -0,0 +1,52 @@
+# Path: ols_svc_sample/benchmarks/serialization.py
+# CPU cost per request of building the GET /v1/profiles/{uuid} response body:
+#   hit  before: ujson.loads the cached string, then JSONResponse encodes it again
+#   hit  after:  the cached bytes are the response body
+#   miss before: ujson.dumps for the cache, then JSONResponse encodes the dict again
+#   miss after:  orjson.dumps once, the same bytes go to the cache and the response
+# Usage: python -m benchmarks.serialization [iterations]
+
+import sys, timeit, ujson, orjson
+from fastapi.responses import JSONResponse, Response
+
+PROFILE = {
+    "uuid": "0b7e6a3e-3f4e-4f7a-9a55-0d3c2a1b7c9e",
+    "email": "bench@example.com",
+    "firstname": "Bench",
+    "lastname": "Mark",
+    "birthdate": "1990-01-01",
+    "gender": "female",
+    "addresses": [
+        {"type": "home", "address": "Jl. Sudirman 1", "city": "Jakarta", "province": "DKI Jakarta", "country": "Indonesia", "postalCode": 12190},
+        {"type": "work", "address": "Jl. Thamrin 2", "city": "Jakarta", "province": "DKI Jakarta", "country": "Indonesia", "postalCode": 10350},
+    ],
+    "image": {"name": "bench.png", "url": "https://example.com/bench.png"},
+    "createdAt": "2024-01-01T00:00:00",
+    "updatedAt": "2024-01-01T00:00:00",
+}
+CACHED_STR = ujson.dumps(PROFILE)
+CACHED_BYTES = orjson.dumps(PROFILE)
+
+def hit_before():
+    JSONResponse(content=ujson.loads(CACHED_STR))
+
+def hit_after():
+    Response(content=CACHED_BYTES, media_type="application/json")
+
+def miss_before():
+    ujson.dumps(PROFILE)
+    JSONResponse(content=PROFILE)
+
+def miss_after():
+    Response(content=orjson.dumps(PROFILE), media_type="application/json")
+
+def run(name: str, fn, iterations: int) -> float:
+    elapsed = min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations * 1e6
+    print(f"{name:<12} {elapsed:.2f}us/request")
+    return elapsed
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for path, before, after in (("hit", hit_before, hit_after), ("miss", miss_before, miss_after)):
+        saved = run(f"{path} before", before, iterations) - run(f"{path} after", after, iterations)
+        print(f"{path} saved  {saved:.2f}us/request")
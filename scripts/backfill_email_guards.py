@@ -0,0 +1,83 @@
+# Path: ols_svc_sample/scripts/backfill_email_guards.py
+# Create the email guard of every existing profile, which keeps emails unique on DynamoDB and Firestore:
+#   aws:   one item per email in DYNAMODB_EMAIL_TABLE, keyed by email
+#   gcp:   one document per email in FIRESTORE_EMAIL_COLLECTION, keyed by the sha256 of the email
+#   local: MongoDB keeps emails unique with the email_1 index, the emails preventing it are listed
+# Guards are created only if missing, so the backfill can be run again, e.g. after a partial run;
+# emails used by more than one profile are listed and must be fixed by hand
+# Usage: python -m scripts.backfill_email_guards
+
+import sys
+from app.internal.config import get_settings
+
+settings = get_settings()
+
+def report(duplicates: list[tuple[str, str, str]]) -> int:
+    for email, uuid, owner in duplicates:
+        print(f"duplicate email {email}: profile {uuid} conflicts with profile {owner}")
+    return 1 if duplicates else 0
+
+def backfill_dynamodb() -> int:
+    from botocore.exceptions import ClientError
+    from app.internal.infrastructure.aws.dynamodb import DynamoDB
+    database = DynamoDB()
+    table = database.get_table()
+    emails = database.client.Table(settings.dynamodb_email_table)
+    created, existing, duplicates = 0, 0, []
+    scan = {"ProjectionExpression": "#uuid, email", "ExpressionAttributeNames": {"#uuid": "uuid"}}
+    while True:
+        response = table.scan(**scan)
+        for item in response.get("Items", []):
+            try:
+                emails.put_item(Item={"email": item["email"], "uuid": item["uuid"]}, ConditionExpression="attribute_not_exists(email)")
+                created += 1
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                owner = emails.get_item(Key={"email": item["email"]}, ConsistentRead=True)["Item"]["uuid"]
+                if owner == item["uuid"]:
+                    existing += 1
+                else:
+                    duplicates.append((item["email"], item["uuid"], owner))
+        if "LastEvaluatedKey" not in response:
+            break
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    print(f"{created} email guards created, {existing} already existed")
+    return report(duplicates)
+
+def backfill_firestore() -> int:
+    from google.api_core.exceptions import Conflict
+    from google.cloud import firestore
+    from app.internal.infrastructure.gcp.firestore import guard_id
+    client = firestore.Client(database=settings.firestore_database, project=settings.firestore_project_id)
+    emails = client.collection(settings.firestore_email_collection)
+    created, existing, duplicates = 0, 0, []
+    for snapshot in client.collection(settings.firestore_collection).select(["uuid", "email"]).stream():
+        email, uuid = snapshot.get("email"), snapshot.get("uuid")
+        try:
+            emails.document(guard_id(email)).create({"email": email, "uuid": uuid})
+            created += 1
+        except Conflict:
+            owner = emails.document(guard_id(email)).get().get("uuid")
+            if owner == uuid:
+                existing += 1
+            else:
+                duplicates.append((email, uuid, owner))
+    print(f"{created} email guards created, {existing} already existed")
+    return report(duplicates)
+
+def check_mongo() -> int:
+    import pymongo
+    from app.internal.infrastructure.databases.mongodb import Mongo
+    client = pymongo.MongoClient(Mongo().uri)
+    collection = client[settings.mongo_dbname][settings.mongo_collection]
+    duplicates = []
+    for group in collection.aggregate([{"$group": {"_id": "$email", "uuids": {"$push": "$uuid"}}}, {"$match": {"uuids.1": {"$exists": True}}}]):
+        owner, *others = group["uuids"]
+        duplicates.extend((group["_id"], uuid, owner) for uuid in others)
+    print("the email_1 unique index keeps emails unique, it is created at startup" if not duplicates else "the email_1 unique index cannot be created over duplicate emails")
+    return report(duplicates)
+
+if __name__ == "__main__":
+    backfills = {"aws": backfill_dynamodb, "gcp": backfill_firestore, "local": check_mongo}
+    sys.exit(backfills[settings.cloud_provider]())
@@ -0,0 +1,41 @@
+# Path: ols_svc_sample/tests/conftest.py
+
+import contextlib, os
+
+## the service runs against mongo and redis doubles, with the rate limits out of the way
+os.environ["CLOUD_PROVIDER"] = "local"
+os.environ["CACHE_BACKEND"] = "redis"
+os.environ["L1_CACHE_ENABLED"] = "false"
+os.environ["RATE_LIMIT_TIMES"] = "100000"
+os.environ["RATE_LIMIT_ROUTES"] = ""
+
+import pytest
+from fakeredis import aioredis as fakeredis
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+from app.internal.adapter import event_handler
+from app.internal.infrastructure.databases.mongodb import PROFILE_INDEXES, unique_email
+
+# Registries of the lifespan filled with a fresh in-memory datastore and cache per test
+@pytest.fixture
+def client():
+    collection = AsyncMongoMockClient()["ols_svc_profile"]["Profile"]
+    cache = fakeredis.FakeRedis()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        for index in PROFILE_INDEXES:
+            await collection.create_index(list(index.keys), name=index.name, unique=index.unique)
+        event_handler.mongo.update(collection=collection, scan=collection, get=collection, unique_email=await unique_email(collection))
+        event_handler.redis["client"] = cache
+        yield
+        event_handler.mongo.clear()
+        event_handler.redis.clear()
+
+    main.app.router.lifespan_context = lifespan
+    with TestClient(main.app) as client:
+        client.cache = cache
+        client.collection = collection
+        yield client
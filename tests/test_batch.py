@@ -0,0 +1,80 @@
+# Path: ols_svc_sample/tests/test_batch.py
+
+from app.internal.adapter import event_handler
+from app.internal.adapter.transport.http.profile_router import profile_service
+
+def create(client, email: str, firstname: str) -> str:
+    response = client.post("/v1/profiles", json={"email": email, "firstname": firstname})
+    assert response.status_code == 201
+    return response.json()["uuid"]
+
+def test_post_batch_reports_taken_emails(client):
+    create(client, "a@x.com", "A")
+    response = client.post("/v1/profiles:batch", json=[{"email": "b@x.com"}, {"email": "a@x.com"}, {"email": "b@x.com"}])
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()] == [201, 409, 409]
+    uuid = response.json()[0]["uuid"]
+    assert client.get(f"/v1/profiles/{uuid}").json()["email"] == "b@x.com"
+
+def test_put_batch_reports_each_item(client):
+    a = create(client, "a@x.com", "A")
+    b = create(client, "b@x.com", "B")
+    response = client.put("/v1/profiles:batch", json=[
+        {"uuid": a, "firstname": "A2"},
+        {"uuid": b, "email": "a@x.com"},
+        {"uuid": "missing", "firstname": "X"},
+    ])
+    assert response.status_code == 200
+    assert [(result["uuid"], result["status"]) for result in response.json()] == [(a, 200), (b, 409), ("missing", 404)]
+    ### the failed item is left as it was, the others are applied
+    assert client.get(f"/v1/profiles/{a}").json()["firstname"] == "A2"
+    assert client.get(f"/v1/profiles/{b}").json()["email"] == "b@x.com"
+
+def test_put_batch_invalidates_cache(client):
+    uuid = create(client, "a@x.com", "A")
+    client.get(f"/v1/profiles/{uuid}")
+    assert client.get(f"/v1/profiles/{uuid}").headers["x-cache"] == "HIT"
+    client.put("/v1/profiles:batch", json=[{"uuid": uuid, "firstname": "A2"}])
+    response = client.get(f"/v1/profiles/{uuid}")
+    assert response.headers["x-cache"] == "MISS"
+    assert response.json()["firstname"] == "A2"
+
+def test_delete_batch_invalidates_cache(client):
+    a = create(client, "a@x.com", "A")
+    b = create(client, "b@x.com", "B")
+    client.get(f"/v1/profiles/{a}")
+    response = client.request("DELETE", "/v1/profiles:batch", json=[a, "missing"])
+    assert [result["status"] for result in response.json()] == [204, 404]
+    assert client.get(f"/v1/profiles/{a}").status_code == 404
+    assert client.get(f"/v1/profiles/{b}").status_code == 200
+
+def test_batch_get_reports_each_item(client):
+    a = create(client, "a@x.com", "A")
+    response = client.post("/v1/profiles:batchGet", json=[a, "missing"])
+    assert response.status_code == 200
+    assert [(result["uuid"], result["status"]) for result in response.json()] == [(a, 200), ("missing", 404)]
+    assert response.json()[0]["data"]["firstname"] == "A"
+
+def test_batch_size_is_bounded(client):
+    response = client.post("/v1/profiles:batchGet", json=[str(index) for index in range(10000)])
+    assert response.status_code == 413
+
+def test_emails_are_checked_without_unique_index(client):
+    client.portal.call(client.collection.drop_index, "email_1")
+    event_handler.mongo["unique_email"] = False
+    a = create(client, "a@x.com", "A")
+    b = create(client, "b@x.com", "B")
+    assert client.post("/v1/profiles", json={"email": "a@x.com"}).status_code == 409
+    response = client.put("/v1/profiles:batch", json=[{"uuid": b, "email": "a@x.com"}, {"uuid": a, "email": "a@x.com", "firstname": "A2"}])
+    assert [result["status"] for result in response.json()] == [409, 200]
+
+def test_put_batch_reports_profiles_deleted_meanwhile(client, monkeypatch):
+    a = create(client, "a@x.com", "A")
+    b = create(client, "b@x.com", "B")
+    ### b is deleted after the batch checked it exists
+    async def existing(ids):
+        await event_handler.mongo["collection"].delete_one({"uuid": b})
+        return set(ids)
+    monkeypatch.setattr(profile_service.profile_repo, "existing", existing)
+    response = client.put("/v1/profiles:batch", json=[{"uuid": a, "firstname": "A2"}, {"uuid": b, "firstname": "B2"}])
+    assert [result["status"] for result in response.json()] == [200, 404]
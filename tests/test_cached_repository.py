@@ -0,0 +1,25 @@
+# Path: ols_svc_sample/tests/test_cached_repository.py
+
+import asyncio
+from app.internal.infrastructure.cache.memory import MemoryCacheStore
+from app.internal.infrastructure.repositories.cached.profile_repository import CachedProfileRepository
+from app.internal.infrastructure.repositories.local.profile_repository import ProfileRepository
+
+def test_hot_key_is_revalidated_once_at_a_time():
+    async def run():
+        repository = CachedProfileRepository(ProfileRepository(), MemoryCacheStore(10))
+        fills = []
+        async def fill(id, fields=None, latest=False):
+            fills.append(id)
+            await asyncio.sleep(0.01)
+        repository.fill = fill
+        for _ in range(100):
+            repository.revalidate("a")
+        assert len(repository.revalidating) == 1
+        await asyncio.sleep(0.05)
+        assert fills == ["a"] and not repository.revalidating
+        ### a refresh that landed does not prevent the next one
+        repository.revalidate("a")
+        await asyncio.sleep(0.05)
+        assert fills == ["a", "a"]
+    asyncio.run(run())
@@ -0,0 +1,124 @@
+# Path: ols_svc_sample/tests/test_guarded_cache.py
+
+import asyncio
+import pytest
+from app.internal.config import get_settings
+from app.internal.infrastructure.breaker import CircuitBreaker
+from app.internal.infrastructure.cache.guarded import GuardedCacheStore
+from app.internal.infrastructure.cache.memory import MemoryCacheStore
+
+settings = get_settings()
+
+# Memory store whose next invalidations fail, as a redis timeout would, and every call while down
+class FlakyStore(MemoryCacheStore):
+    def __init__(self):
+        super().__init__(100)
+        self.failures = 0
+        self.down = False
+
+    def fail(self):
+        if self.down:
+            raise ConnectionError("cache is down")
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("cache is down")
+
+    async def getEntry(self, id: str, fields: tuple[str, ...] | None = None):
+        if self.down:
+            raise ConnectionError("cache is down")
+        return await super().getEntry(id, fields)
+
+    async def deleteEntry(self, id: str):
+        self.fail()
+        await super().deleteEntry(id)
+
+    async def deleteEntries(self, ids: list[str]):
+        self.fail()
+        await super().deleteEntries(ids)
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(settings, "cache_invalidation_backoff", 1)
+    monkeypatch.setattr(settings, "cache_invalidation_backoff_max", 5)
+
+def test_failed_invalidation_is_retried_while_breaker_stays_closed():
+    async def run():
+        store = FlakyStore()
+        guarded = GuardedCacheStore(store)
+        await guarded.setEntry("a", b"{}", "v1")
+        store.failures = 2
+        await guarded.deleteEntry("a")
+        assert guarded.breaker.state == "closed"
+        ### the profile is read from the datastore until the invalidation is applied
+        assert "a" in guarded.stale
+        assert (await guarded.getEntry("a")).body is None
+        await asyncio.wait_for(guarded.retrying, 1)
+        assert not guarded.stale and store.failures == 0
+        assert (await store.getEntry("a")).body is None
+    asyncio.run(run())
+
+def test_set_entry_clears_failed_invalidation():
+    async def run():
+        store = FlakyStore()
+        guarded = GuardedCacheStore(store)
+        store.failures = 100
+        await guarded.deleteEntry("a")
+        assert "a" in guarded.stale
+        await guarded.setEntry("a", b"{}", "v2")
+        assert "a" not in guarded.stale
+        assert (await guarded.getEntry("a")).version == "v2"
+        guarded.retrying.cancel()
+    asyncio.run(run())
+
+def test_breaker_opens_probes_and_closes():
+    async def run():
+        breaker = CircuitBreaker("test", window=4, min_calls=2, failure_rate=0.5, reset_timeout=0.05, probes=2)
+        calls = []
+        async def fail():
+            calls.append("fail")
+            raise ConnectionError("down")
+        async def succeed():
+            calls.append("ok")
+            return "ok"
+        assert await breaker.call(fail, "fallback") == "fallback"
+        assert breaker.state == "closed"
+        await breaker.call(fail)
+        assert breaker.state == "open"
+        ### while open the backend is not called
+        assert await breaker.call(succeed, "fallback") == "fallback" and calls == ["fail", "fail"]
+        await asyncio.sleep(0.06)
+        ### a failed probe opens the breaker again
+        await breaker.call(fail)
+        assert breaker.state == "open"
+        await asyncio.sleep(0.06)
+        assert await breaker.call(succeed) == "ok"
+        assert breaker.state == "half_open"
+        assert await breaker.call(succeed) == "ok"
+        assert breaker.state == "closed"
+    asyncio.run(run())
+
+def test_invalidations_failed_while_open_are_replayed_once_closed(monkeypatch):
+    monkeypatch.setattr(settings, "cache_breaker_min_calls", 2)
+    monkeypatch.setattr(settings, "cache_breaker_reset_timeout", 0.05)
+    monkeypatch.setattr(settings, "cache_breaker_probes", 1)
+    ### the backoff outlasts the test, only the breaker closing replays the invalidations
+    monkeypatch.setattr(settings, "cache_invalidation_backoff", 60000)
+    monkeypatch.setattr(settings, "cache_invalidation_backoff_max", 60000)
+    async def run():
+        store = FlakyStore()
+        guarded = GuardedCacheStore(store)
+        await guarded.setEntry("a", b"{}", "v1")
+        store.down = True
+        await guarded.getEntry("b")
+        await guarded.getEntry("b")
+        assert guarded.breaker.state == "open"
+        await guarded.deleteEntry("a")
+        assert "a" in guarded.stale
+        store.down = False
+        await asyncio.sleep(0.06)
+        await guarded.getEntry("b")
+        assert guarded.breaker.state == "closed"
+        await asyncio.wait_for(guarded.retrying, 1)
+        assert not guarded.stale
+        assert (await store.getEntry("a")).body is None
+    asyncio.run(run())
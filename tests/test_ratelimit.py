@@ -0,0 +1,69 @@
+# Path: ols_svc_sample/tests/test_ratelimit.py
+
+import asyncio, contextlib
+import fakeredis
+import pytest
+from fakeredis import aioredis
+from app.internal.config import get_settings
+from app.internal.infrastructure.metrics import metrics
+from app.internal.infrastructure.ratelimit import RateLimiter
+
+settings = get_settings()
+
+@pytest.fixture(autouse=True)
+def fast_syncs(monkeypatch):
+    monkeypatch.setattr(settings, "rate_limit_sync_interval", 10)
+    monkeypatch.setattr(settings, "rate_limit_sync_timeout", 100)
+    ### each limiter registers its gauge, the one of the service is restored afterwards
+    monkeypatch.setitem(metrics.gauges, "rate_limit", metrics.gauges.get("rate_limit"))
+
+# Run the reconciliation of a limiter for the duration of the block
+@contextlib.asynccontextmanager
+async def running(limiter: RateLimiter, client):
+    task = asyncio.create_task(limiter.run(client))
+    try:
+        yield
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+async def eventually(condition, timeout: float = 1.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+def test_limits_locally_while_redis_is_down_and_syncs_once_it_recovers():
+    async def run():
+        server = fakeredis.FakeServer()
+        client = aioredis.FakeRedis(server=server)
+        limiter = RateLimiter()
+        async with running(limiter, client):
+            server.connected = False
+            ### a sync is attempted once a bucket is used
+            limiter.acquire("get:probe", 10, 60)
+            await eventually(lambda: not limiter.distributed)
+            ### the worker keeps the whole limit to itself
+            admitted = [limiter.acquire("get:a", 10, 60) == 0 for _ in range(11)]
+            assert admitted.count(True) == 10 and not admitted[-1]
+            server.connected = True
+            await eventually(lambda: limiter.distributed)
+            assert limiter.snapshot()["mode"] == "distributed"
+            ### the tokens taken from then on are charged to the global bucket
+            admitted = sum(limiter.acquire("get:b", 10, 60) == 0 for _ in range(3))
+            await eventually(lambda: limiter.buckets["get:b"].unreported == 0 and limiter.buckets["get:b"].synced)
+            assert admitted and round(float(await client.hget("ratelimit:get:b", "tokens"))) == 10 - admitted
+    asyncio.run(run())
+
+def test_workers_share_the_limit_through_redis():
+    async def run():
+        client = aioredis.FakeRedis(server=fakeredis.FakeServer())
+        first, second = RateLimiter(), RateLimiter()
+        async with running(first, client), running(second, client):
+            await eventually(lambda: first.distributed and second.distributed)
+            while first.acquire("get:a", 10, 60) == 0:
+                await asyncio.sleep(0.02)
+            await eventually(lambda: not first.buckets["get:a"].unreported)
+            ### the tokens the first worker took are no longer available to the second
+            assert sum(second.acquire("get:a", 10, 60) == 0 for _ in range(10)) <= 1
+    asyncio.run(run())
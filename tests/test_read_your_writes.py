@@ -0,0 +1,39 @@
+# Path: ols_svc_sample/tests/test_read_your_writes.py
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from app.internal.adapter import event_handler
+
+# Secondary that has not replicated any write yet, serving the reads that may be stale
+@pytest.fixture
+def lagging(client):
+    secondary = AsyncMongoMockClient()["ols_svc_profile"]["Profile"]
+    event_handler.mongo.update(scan=secondary, get=secondary)
+    return secondary
+
+def create(client, email: str, firstname: str) -> str:
+    response = client.post("/v1/profiles", json={"email": email, "firstname": firstname})
+    assert response.status_code == 201
+    assert response.cookies.get("recent_write")
+    return response.json()["uuid"]
+
+def test_reads_after_a_write_are_served_from_the_primary(client, lagging):
+    uuid = create(client, "a@x.com", "A")
+    client.portal.call(client.cache.flushall)
+    assert client.get(f"/v1/profiles/{uuid}").json()["firstname"] == "A"
+    assert client.post("/v1/profiles:batchGet", json=[uuid]).json()[0]["status"] == 200
+    assert uuid in client.get("/v1/profiles").text
+    ### other clients read from the secondary
+    client.cookies.clear()
+    client.portal.call(client.cache.flushall)
+    assert client.get(f"/v1/profiles/{uuid}").status_code == 404
+    assert uuid not in client.get("/v1/profiles").text
+
+def test_cache_fill_after_a_write_reads_the_primary(client, lagging):
+    uuid = create(client, "a@x.com", "A")
+    client.put("/v1/profiles:batch", json=[{"uuid": uuid, "firstname": "A2"}])
+    ### a client without the cookie misses the cache invalidated by the batch, the fill still reads the primary
+    client.cookies.clear()
+    response = client.get(f"/v1/profiles/{uuid}")
+    assert response.headers["x-cache"] == "MISS"
+    assert response.json()["firstname"] == "A2"